@@ -7,26 +7,35 @@ __license__ = 'GPL v3'
 __copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
 __docformat__ = 'restructuredtext cs'
 
+import re
 import time
-import unicodedata
 import string
 
 from urllib import quote
 from Queue import Queue, Empty
+from threading import Event
 
-from lxml.html import fromstring, tostring
+from lxml.html import fromstring
 
 from calibre import as_unicode
 from calibre.ebooks.metadata import check_isbn
+from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.metadata.sources.base import Source
-from calibre.utils.icu import lower
 from calibre.utils.cleantext import clean_ascii_chars
 
-from calibre import ipython
+from calibre_plugins.CBDB.fetch import CircuitOpenError, coalescer, open_url, read_url
+from calibre_plugins.CBDB.matching import (canonical_words, fold_accents,
+                                           parse_rating_icon, TokenMatcher)
 
 BASE_URL = 'http://www.cbdb.cz'
 BASE_BOOK_URL = '%s/kniha-%s'
-MAX_EDITIONS = 5
+
+# Search results page without a single book
+NO_RESULTS_RE = re.compile(br'<h2>Nalezeno[^:<]*:\s*0\s*</h2>')
+
+
+def parse_CBDB_id(url):
+    return url.split('/')[-1].split('-')[1]
 
 
 class CBDB(Source):
@@ -75,34 +84,59 @@ class CBDB(Source):
             urls = self.cached_identifier_to_cover_url(CBDB_id)
         return urls
 
-    def identify(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30, nested=False):
+    def identify(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30, nested=False, options=None):
         matches = []
+        prefetched = {}
+        search_rows = {}
 
-        ipython(locals())
+        from calibre_plugins.CBDB.config import (get_options_snapshot,
+                SEARCH_ROWS_OFF, SEARCH_ROWS_ONLY)
+        if options is None:
+            options = get_options_snapshot()
 
         CBDB_id = identifiers.get('cbdb', None)
         isbn = check_isbn(identifiers.get('isbn', None))
         br = self.browser
 
+        if not CBDB_id and options.local_index:
+            matches.extend(self._search_local_index(log, title, authors, isbn,
+                                                    options.max_search_results))
+
+        if (not CBDB_id and not matches and not isbn and title and authors and
+                options.author_bibliography):
+            from calibre_plugins.CBDB.bibliography import find_in_bibliography
+            matches.extend(find_in_bibliography(self, log, br, title, authors, timeout,
+                                                options.max_search_results))
+
         if CBDB_id:
             matches.append(BASE_BOOK_URL % (BASE_URL, CBDB_id))
+        elif matches:
+            log.info('Already found %d matches, not searching CBDB' % len(matches))
         else:
             query = self.create_query(
                 log, title=title, authors=authors, identifiers=identifiers)
             if query is None:
                 log.error('Insufficient metadata to construct query')
                 return
+            query_key = self.create_query_key(
+                title=title, authors=authors, identifiers=identifiers)
             try:
                 log.info('Querying: %s' % query)
-                response = br.open_novisit(query, timeout=timeout)
+                location, body = self._search(log, br, query, query_key, timeout)
                 if isbn:
                     # Check whether we got redirected to a book page for ISBN searches.
                     # If we did, will use the url.
                     # If we didn't then treat it as no matches on CBDB
-                    location = response.geturl()
                     if '/kniha-' in location:
                         log.info('ISBN match location: %r' % location)
                         matches.append(location)
+                        # The redirect already returned the book page, so
+                        # hand it to the worker instead of downloading it again
+                        prefetched[location] = body
+            except CircuitOpenError as e:
+                log.error(as_unicode(e))
+                return as_unicode(e)
+
             except IOError as e:
                 err = 'Connection problem. Check your Internet connection'
                 log.warning(err)
@@ -119,7 +153,7 @@ class CBDB(Source):
             # CBDB doesn't redirect anymore when there's just one match
             if not isbn or (isbn and matches.__len__() == 0):
                 try:
-                    raw = response.read().strip()
+                    raw = body.strip()
                     # open('E:\\t.html', 'wb').write(raw)
                     # raw = open('S:\\t.html', 'rb').read()
                     raw = raw.decode('utf-8', errors='replace')
@@ -202,7 +236,9 @@ class CBDB(Source):
                     self._parse_isbn_search_results(log, root, matches)
                 else:
                     self._parse_search_results(
-                        log, title, authors, root, matches, timeout)
+                        log, title, authors, root, matches, timeout,
+                        max_results=options.max_search_results,
+                        search_rows=search_rows)
 
         if abort.is_set():
             return
@@ -213,37 +249,70 @@ class CBDB(Source):
 
             log.info('No matches found, trying to strip accents')
 
-            if (not self.identify(log, result_queue, abort, title=self.strip_accents(title), authors=self.strip_accents(authors), timeout=30, nested=True)):
+            if (not self.identify(log, result_queue, abort, title=self.strip_accents(title), authors=self.strip_accents(authors), timeout=30, nested=True, options=options)):
                 log.info('No matches found, trying to strip numbers')
 
-                if (not self.identify(log, result_queue, abort, title=self.strip_accents(title.rstrip(string.digits)), authors=self.strip_accents(authors), timeout=30, nested=True)):
+                if (not self.identify(log, result_queue, abort, title=self.strip_accents(title.rstrip(string.digits)), authors=self.strip_accents(authors), timeout=30, nested=True, options=options)):
                     log.error('No matches found with query: %r' % query)
 
             return
 
+        if search_rows and options.search_rows_mode != SEARCH_ROWS_OFF:
+            self._put_search_row_results(log, result_queue, matches, search_rows)
+            if options.search_rows_mode == SEARCH_ROWS_ONLY:
+                return None
+
         # log.info('Lets process matches ...')
         from calibre_plugins.CBDB.worker import Worker
-        workers = [Worker(url, result_queue, br, log, i, self)
+        fields = self.get_wanted_fields()
+        # Set by the first worker whose book has exactly the title and all the
+        # authors searched for, the remaining candidates are then not fetched.
+        # Only title/author searches return more than one candidate.
+        decisive = Event()
+        exact = None
+        if len(matches) > 1 and title and authors and not CBDB_id and not isbn:
+            exact = TokenMatcher(self.get_title_tokens(title),
+                                 self.get_author_tokens(authors), title=title)
+        workers = [Worker(url, result_queue, br, log, i, self, options=options,
+                          raw=prefetched.get(url), fields=fields, isbn=isbn,
+                          CBDB_id=CBDB_id, decisive=decisive, exact=exact)
                    for i, url in enumerate(matches)]
 
         for w in workers:
+            if abort.is_set() or decisive.is_set():
+                break
             w.start()
             # Don't send all requests at the same time
             time.sleep(0.1)
 
-        while not abort.is_set():
+        while not abort.is_set() and not decisive.is_set():
             a_worker_is_alive = False
             for w in workers:
                 w.join(0.2)
-                if abort.is_set():
+                if abort.is_set() or decisive.is_set():
                     break
                 if w.is_alive():
                     a_worker_is_alive = True
             if not a_worker_is_alive:
                 break
 
+        if decisive.is_set():
+            log.info('Found an exact title and author match, not waiting for the remaining results')
+        if options.parse_processes:
+            from calibre_plugins.CBDB.parsing import parser_pool
+            parser_pool.shutdown_later()
+
         return None
 
+    def get_wanted_fields(self):
+        '''
+        The touched fields that have not been turned off, either in the global
+        metadata download settings or in the settings for this source
+        '''
+        from calibre.ebooks.metadata.sources.prefs import msprefs
+        ignored = set(msprefs['ignore_fields']) | set(self.prefs['ignore_fields'])
+        return self.touched_fields - ignored
+
     # disable isbn merging
     def merge_identify_results(self, result_map, log):
         return result_map
@@ -281,6 +350,48 @@ class CBDB(Source):
             q = q.encode('utf-8')
         return BASE_URL + '/vyhledavani.php?ok=VYHLEDAT&' + q
 
+    def create_query_key(self, title=None, authors=None, identifiers={}):
+        '''
+        Key for caching and coalescing the search create_query() makes. The
+        same for queries that differ only in case, whitespace, the subtitle
+        or the order of the author's names. Accents are kept, CBDB searches
+        with and without them differ and identify retries without them.
+        '''
+        isbn = check_isbn(identifiers.get('isbn', None))
+        if isbn is not None:
+            return 'isbn:' + isbn
+        if title:
+            return 'title:' + canonical_words(self.get_title_tokens(
+                title, strip_joiners=False, strip_subtitle=True), accents=True)
+        if authors:
+            return 'author:' + canonical_words(self.get_author_tokens(
+                authors, only_first_author=True), ordered=False, accents=True)
+
+    def _search(self, log, br, query, key, timeout):
+        '''
+        (final url, body) of a CBDB search. Searches with the same key share
+        one request while it runs and its cached result afterwards.
+        '''
+        from calibre_plugins.CBDB.cache import search_cache
+        cached = search_cache.get(key)
+        if cached is not None:
+            log.info('Using cached search results for %r' % key)
+            return cached
+
+        def fetch():
+            location, body = open_url(br, query, timeout, log)
+            # Empty results are not kept, the accent stripping retries of
+            # identify have to reach CBDB
+            if '/kniha-' in location or (b'<h2>Nalezeno' in body and
+                                         not NO_RESULTS_RE.search(body)):
+                try:
+                    search_cache.put(key, location, body)
+                except:
+                    log.exception('Failed to cache search results: %r' % query)
+            return location, body
+
+        return coalescer(key, fetch)
+
     def strip_accents(self, inp):
         if isinstance(inp, list):
             li = []
@@ -288,7 +399,33 @@ class CBDB(Source):
                 li.append(self.strip_accents(s))
 
             return li
-        return ''.join((c for c in unicodedata.normalize('NFD', inp) if unicodedata.category(c) != 'Mn'))
+        return fold_accents(inp)
+
+    def _search_local_index(self, log, title, authors, isbn, max_results):
+        '''
+        Book urls for the query from the local index. A title/author query
+        is only answered with books of exactly that title and all of the
+        authors, anything less (Duna for Duna Mesiáš) is left to the CBDB
+        search.
+        '''
+        from calibre_plugins.CBDB.index import book_index
+        try:
+            if not book_index.ready():
+                return []
+            if isbn:
+                urls = book_index.find_isbn(isbn)[:1]
+            elif title and authors:
+                title_tokens = list(self.get_title_tokens(title))
+                author_tokens = list(self.get_author_tokens(authors))
+                matcher = TokenMatcher(title_tokens, author_tokens, title=title)
+                urls = [url for url, row_title, row_authors in book_index.find(title_tokens, author_tokens)
+                        if matcher.is_exact(row_title, [row_authors])][:max_results]
+            else:
+                urls = []
+        except:
+            log.exception('Failed to search the local index')
+            return []
+        return urls
 
     def _parse_isbn_search_results(self, log, root, matches):
         header = root.xpath('//h3')
@@ -315,7 +452,7 @@ class CBDB(Source):
             log.info('RURL ' + result_url)
             matches.append(result_url)
 
-    def _parse_search_results(self, log, orig_title, orig_authors, root, matches, timeout):
+    def _parse_search_results(self, log, orig_title, orig_authors, root, matches, timeout, max_results=None, search_rows=None):
         header = root.xpath('//h3')
         if not header:
             return
@@ -325,47 +462,16 @@ class CBDB(Source):
             log.info(header.__len__())
             return
 
-        def ismatch(title, authors, title_tokens, author_tokens):
-            authors = lower(' '.join(authors))
-            title = lower(title)
-
-            match = not title_tokens
-            for t in title_tokens:
-                if lower(t) in title:
-                    match = True
-                    break
-
-            amatch = not author_tokens
-            for a in author_tokens:
-                if lower(a) in authors:
-                    amatch = True
-                    break
-
-            if not author_tokens:
-                amatch = True
-
-            return match and amatch
-
-        title_tokens = list(self.get_title_tokens(orig_title))
-        author_tokens = list(self.get_author_tokens(orig_authors))
-        ntitle_tokens = list(self.get_title_tokens(
-            self.strip_accents(orig_title)))
-        nauthor_tokens = list(self.get_author_tokens(
-            self.strip_accents(orig_authors)))
-        # log.info(orig_title)
-        # log.info(orig_authors)
-        # log.info(self.strip_accents(orig_title))
-        # log.info(self.strip_accents(orig_authors))
+        matcher = TokenMatcher(self.get_title_tokens(orig_title),
+                               self.get_author_tokens(orig_authors), title=orig_title)
 
         cnt = int(header[0].text)
         # log.info(cnt)
-        i = 0
-        while i < cnt:
-            i += 1
-            # log.info(i)
-            xresult = root.xpath('//table/tr[' + str(i) + ']/td')
+        ranked = []
+        for i, row in enumerate(root.xpath('//table/tr')[:cnt]):
+            xresult = row.xpath('./td')
             if not xresult:
-                return
+                break
 
             # log.info(xresult.__len__())
             # log.info(xresult[1].xpath('./a')[0].text_content())
@@ -375,89 +481,75 @@ class CBDB(Source):
                 './a')[0].text_content().strip().decode('utf-8', errors='replace')
             authors = xresult[3].xpath(
                 './a')[0].text_content().strip().decode('utf-8', errors='replace').split(',')
-            ntitle = self.strip_accents(title)
-            nauthors = self.strip_accents(authors)
-            # rank = xresult[0].xpath('./img/@src')[0][13]
+            rating_icon = xresult[0].xpath('./img/@src')
+            rating = parse_rating_icon(rating_icon[0]) if rating_icon else None
 
-            if not ismatch(title, authors, title_tokens, author_tokens):
-                if not ismatch(ntitle, nauthors, ntitle_tokens, nauthor_tokens):
-                    log.error('Rejecting as not close enough match: %s %s' %
-                              (title, authors))
-                    continue
+            score = matcher.score(title, authors, rating)
+            if score is None:
+                log.error('Rejecting as not close enough match: %s %s' %
+                          (title, authors))
+                continue
 
             xresult_url_node = xresult[1].xpath('./a/@href')
             if xresult_url_node:
                 result_url = BASE_URL + '/' + xresult_url_node[0]
-                log.info('RURL ' + result_url)
-                matches.append(result_url)
-
-    def _parse_editions_for_book(self, log, editions_url, matches, timeout, title_tokens):
-
-        def ismatch(title):
-            title = lower(title)
-            match = not title_tokens
-            for t in title_tokens:
-                if lower(t) in title:
-                    match = True
-                    break
-            return match
+                # CBDB order breaks ties between equally scored rows
+                ranked.append((-score, i, result_url))
+                if search_rows is not None:
+                    search_rows[result_url] = (title, authors)
+
+        ranked.sort()
+        if max_results:
+            if len(ranked) > max_results:
+                log.info('Fetching details for the best %d of %d matches' %
+                         (max_results, len(ranked)))
+            ranked = ranked[:max_results]
+        for neg_score, i, result_url in ranked:
+            log.info('RURL %s (score %.2f)' % (result_url, -neg_score))
+            matches.append(result_url)
 
-        br = self.browser
-        try:
-            raw = br.open_novisit(editions_url, timeout=timeout).read().strip()
-        except Exception as e:
-            err = 'Failed identify editions query: %r' % editions_url
-            log.exception(err)
-            return as_unicode(e)
-        try:
-            raw = raw.decode('utf-8', errors='replace')
-            if not raw:
-                log.error('Failed to get raw result for query: %r' %
-                          editions_url)
-                return
-            # open('E:\\s.html', 'wb').write(raw)
-            root = fromstring(clean_ascii_chars(raw))
-        except:
-            msg = 'Failed to parse CBDB page for query: %r' % editions_url
-            log.exception(msg)
-            return msg
-
-        first_non_valid = None
-        for div_link in root.xpath('//div[@class="editionData"]/div[1]/a[@class="bookTitle"]'):
-            title = tostring(div_link, 'text').strip().lower()
-            if title:
-                # Verify it is not an audio edition
-                valid_title = True
-                for exclusion in ['(audio cd)', '(compact disc)', '(audio cassette)']:
-                    if exclusion in title:
-                        log.info('Skipping audio edition: %s' % title)
-                        valid_title = False
-                        if first_non_valid is None:
-                            first_non_valid = BASE_URL + div_link.get('href')
-                        break
-                if valid_title:
-                    # Verify it is not a foreign language edition
-                    if not ismatch(title):
-                        log.info('Skipping alternate title:', title)
-                        continue
-                    matches.append(BASE_URL + div_link.get('href'))
-                    if len(matches) >= CBDB.MAX_EDITIONS:
-                        return
-        if len(matches) == 0 and first_non_valid:
-            # We have found only audio editions. In which case return the first match
-            # rather than tell the user there are no matches.
-            log.info('Choosing the first audio edition as no others found.')
-            matches.append(first_non_valid)
+    def _put_search_row_results(self, log, result_queue, matches, search_rows):
+        '''
+        Preliminary results built from the search result rows alone, so title,
+        authors and the CBDB id are available before any book page is fetched
+        '''
+        for i, url in enumerate(matches):
+            row = search_rows.get(url)
+            if row is None:
+                continue
+            title, authors = row
+            authors = [a.strip() for a in authors if a.strip()]
+            try:
+                CBDB_id = parse_CBDB_id(url)
+            except IndexError:
+                log.error('Could not find CBDB id in search result: %r' % url)
+                continue
+            mi = Metadata(title, authors)
+            mi.set_identifier('cbdb', CBDB_id)
+            # Always ranked behind the book page results (relevance 0 to
+            # len(matches) - 1), so duplicate removal keeps the full record
+            mi.source_relevance = len(matches) + i
+            mi.language = 'Czech'
+            # Lets consumers tell these apart from full book page results
+            mi.cbdb_search_row = True
+            self.clean_downloaded_metadata(mi)
+            result_queue.put(mi)
 
     def download_cover(self, log, result_queue, abort, title=None, authors=None, get_best_cover=None, identifiers={}, timeout=30):
+        from calibre_plugins.CBDB.config import get_options_snapshot, SEARCH_ROWS_OFF
+        options = get_options_snapshot()
         cached_urls = self.get_cached_cover_urls(identifiers, log)
         # log.info('dc')
         # log.info(cached_url)
         if cached_urls is None:
             log.info('No cached cover found, running identify')
             rq = Queue()
+            # Only the book pages have the cover urls, an unchanged page
+            # skipped by the incremental refresh would not return them either
             self.identify(log, rq, abort, title=title,
-                          authors=authors, identifiers=identifiers)
+                          authors=authors, identifiers=identifiers,
+                          options=options._replace(search_rows_mode=SEARCH_ROWS_OFF,
+                                                   incremental_refresh=False))
             if abort.is_set():
                 return
             results = []
@@ -480,12 +572,16 @@ class CBDB(Source):
         if abort.is_set():
             return
 
+        hedge = options.hedge_requests
         br = self.browser
         for cached_url in cached_urls:
             log('Downloading covers from:', cached_url)
             try:
-                cdata = br.open_novisit(cached_url, timeout=timeout).read()
+                cdata = read_url(br, cached_url, timeout, log, hedge=hedge)
                 result_queue.put((self, cdata))
+            except CircuitOpenError as e:
+                log.error(as_unicode(e))
+                return
             except:
                 log.exception('Failed to download cover from:', cached_url)
 
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
+__docformat__ = 'restructuredtext cs'
+
+import re
+from threading import Lock
+
+from lxml.html import fromstring
+
+from calibre.utils.cleantext import clean_ascii_chars
+
+import calibre_plugins.CBDB as base
+from calibre_plugins.CBDB.cache import bibliographies
+from calibre_plugins.CBDB.fetch import open_url, read_url
+from calibre_plugins.CBDB.matching import author_key, AUTHOR_WEIGHT, TITLE_WEIGHT, TokenMatcher
+
+# Every title token has to be in a book's title, a near miss would skip the
+# CBDB search that could find the right book
+FULL_TITLE_SCORE = TITLE_WEIGHT + AUTHOR_WEIGHT
+
+AUTHOR_LINK_RE = re.compile(r'(?:^|/)autor-\d+')
+BOOK_LINK_RE = re.compile(r'(?:^|/)kniha-\d+')
+
+# One lock per author, so concurrent identifies of the same author's books
+# download the author page only once
+_author_locks = {}
+_author_locks_lock = Lock()
+
+
+def _author_lock(key):
+    with _author_locks_lock:
+        return _author_locks.setdefault(key, Lock())
+
+
+def parse_html(raw):
+    raw = clean_ascii_chars(raw.strip().decode('utf-8', errors='replace'))
+    idx = raw.find('<!DOCTYPE')
+    return fromstring(raw[idx:] if idx != -1 else raw)
+
+
+def _absolute(href):
+    return href if href.startswith('http') else base.BASE_URL + '/' + href.lstrip('/')
+
+
+def parse_author_search(root, author_tokens):
+    '''
+    url of the author page in an author search result that best matches the
+    author tokens. Only authors with all of the tokens count, a book list of
+    the wrong author would send identify to the wrong books.
+    '''
+    matcher = TokenMatcher([], author_tokens)
+    best = None
+    for a in root.xpath('//a[@href]'):
+        href = a.get('href')
+        if not AUTHOR_LINK_RE.search(href):
+            continue
+        name = [unicode(a.text_content())]
+        if not matcher.has_all_authors(name):
+            continue
+        score = matcher.score('', name)
+        if score is not None and (best is None or score > best[0]):
+            best = (score, _absolute(href))
+    return best[1] if best else None
+
+
+def parse_bibliography(root):
+    '''
+    (title, url) of every book linked from the content of an author or
+    series page
+    '''
+    content = root.xpath('//div[@class="content"]') or [root]
+    books, seen = [], set()
+    for a in content[0].xpath('.//a[@href]'):
+        href = a.get('href')
+        title = unicode(a.text_content()).strip()
+        if not title or not BOOK_LINK_RE.search(href):
+            continue
+        url = _absolute(href)
+        if url not in seen:
+            seen.add(url)
+            books.append((title, url))
+    return books
+
+
+def fetch_bibliography(plugin, log, browser, author, timeout):
+    '''
+    Books on the author page, None when the author page was not found
+    '''
+    query = plugin.create_query(log, authors=[author])
+    if query is None:
+        return None
+    log.info('Querying author: %s' % query)
+    location, raw = open_url(browser, query, timeout, log)
+    # A single match redirects straight to the author page
+    if not AUTHOR_LINK_RE.search(location):
+        author_url = parse_author_search(parse_html(raw),
+                                         list(plugin.get_author_tokens([author])))
+        if author_url is None:
+            log.info('Author not found on CBDB: %s' % author)
+            return None
+        log.info('Author page: %r' % author_url)
+        raw = read_url(browser, author_url, timeout, log)
+    books = parse_bibliography(parse_html(raw))
+    log.info('%d books on the author page of %s' % (len(books), author))
+    return books
+
+
+def get_bibliography(plugin, log, browser, author, timeout):
+    key = author_key(author)
+    if not key:
+        return []
+    with _author_lock(key):
+        books = bibliographies.get(key)
+        if books is None:
+            books = fetch_bibliography(plugin, log, browser, author, timeout)
+            if books is None:
+                # Not kept, the author may be found with the next search
+                return []
+            bibliographies.put(key, books)
+        else:
+            log.info('Using cached bibliography of %s' % author)
+    return books
+
+
+def find_in_bibliography(plugin, log, browser, title, authors, timeout, max_results):
+    '''
+    Book urls for title from the bibliography of the first author, best match
+    first. Empty when the title is not there, the caller then searches CBDB.
+    '''
+    title_tokens = list(plugin.get_title_tokens(title))
+    if not title_tokens:
+        return []
+    try:
+        books = get_bibliography(plugin, log, browser, authors[0], timeout)
+    except:
+        log.exception('Failed to get the bibliography of %s' % authors[0])
+        return []
+    matcher = TokenMatcher(title_tokens, [], title=title)
+    ranked = []
+    for i, (book_title, url) in enumerate(books):
+        score = matcher.score(book_title, [])
+        if score is not None and score >= FULL_TITLE_SCORE:
+            ranked.append((-score, i, url))
+    ranked.sort()
+    for neg_score, i, url in ranked[:max_results]:
+        log.info('Bibliography match %s (score %.2f)' % (url, -neg_score))
+    return [url for neg_score, i, url in ranked[:max_results]]
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
+__docformat__ = 'restructuredtext cs'
+
+# Identify a batch of books outside the GUI:
+# calibre-debug -e bulk.py -- [-j 8] [-o results.jsonl] books.jsonl|books.csv
+#
+# Input records have the keys title, authors, isbn and cbdb, all optional. In
+# JSONL authors is a list or a string, in CSV (with a header row) a string with
+# the authors separated by '&'. One JSONL line is written per input record as
+# soon as it is done, with its results and the time identify took.
+#
+# The summary printed at the end includes the share of searches that repeat an
+# earlier one, once by exact search url and once by canonical query key (see
+# CBDB.create_query_key, it ignores case, whitespace, the subtitle and the
+# order of the author's names but not accents), and how the search cache and
+# coalescing did.
+
+import csv
+import json
+import sys
+import time
+from Queue import Queue
+from threading import Event, Thread
+
+from calibre.ebooks.metadata import string_to_authors
+from calibre.utils.logging import ThreadSafeLog
+
+# Loads the installed plugins, calibre_plugins.CBDB is importable after this
+from calibre.customize.ui import all_metadata_plugins
+from calibre_plugins.CBDB.cache import search_cache
+from calibre_plugins.CBDB.fetch import coalescer, PRIORITY_BULK, set_priority
+
+DEFAULT_CONCURRENCY = 4
+
+
+def find_plugin():
+    for plugin in all_metadata_plugins():
+        if plugin.name == 'CBDB':
+            return plugin
+    raise SystemExit('The CBDB plugin is not installed')
+
+
+def read_records(path):
+    if path.lower().endswith('.csv'):
+        with open(path, 'rb') as f:
+            for row in csv.DictReader(f):
+                yield dict((k.decode('utf-8').strip().lower(), (v or b'').decode('utf-8').strip())
+                           for k, v in row.iteritems() if k)
+    else:
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+
+
+def query_args(record):
+    authors = record.get('authors') or []
+    if not isinstance(authors, list):
+        authors = string_to_authors(authors)
+    identifiers = {}
+    for key in ('isbn', 'cbdb'):
+        if record.get(key):
+            identifiers[key] = unicode(record[key])
+    return dict(title=record.get('title') or None, authors=authors or None,
+                identifiers=identifiers)
+
+
+def metadata_to_dict(mi):
+    return {
+        'title': mi.title,
+        'authors': mi.authors,
+        'series': mi.series,
+        'series_index': mi.series_index if mi.series else None,
+        'identifiers': mi.get_identifiers(),
+        'publisher': mi.publisher,
+        'pubdate': mi.pubdate.isoformat() if mi.pubdate else None,
+        'rating': mi.rating,
+        'tags': mi.tags,
+        'relevance': mi.source_relevance,
+    }
+
+
+def identify_record(plugin, record, timeout, log):
+    results = Queue()
+    start = time.time()
+    error = None
+    try:
+        error = plugin.identify(log, results, Event(), timeout=timeout, **query_args(record))
+    except Exception as e:
+        error = repr(e)
+    elapsed = time.time() - start
+    found = []
+    while not results.empty():
+        found.append(metadata_to_dict(results.get_nowait()))
+    found.sort(key=lambda x: x['relevance'])
+    return {'seconds': round(elapsed, 3), 'error': error, 'results': found}
+
+
+class BulkIdentify(object):
+
+    '''
+    Runs identify for every record in concurrency threads, all requests at
+    bulk priority so an interactive download in the same process goes first
+    '''
+
+    def __init__(self, plugin, concurrency=DEFAULT_CONCURRENCY, timeout=30, log=None):
+        self.plugin = plugin
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.log = log or ThreadSafeLog(level=ThreadSafeLog.ERROR)
+        self.jobs = Queue(concurrency * 2)
+        self.done = Queue()
+
+    def work(self):
+        set_priority(PRIORITY_BULK)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            index, record = job
+            try:
+                result = identify_record(self.plugin, record, self.timeout, self.log)
+            except:
+                self.log.exception('Failed to identify record %d' % index)
+                result = {'seconds': None, 'error': 'internal error', 'results': []}
+            result['index'] = index
+            result['input'] = record
+            self.done.put(result)
+
+    def feed(self, records):
+        count = 0
+        try:
+            for count, record in enumerate(records, 1):
+                self.jobs.put((count - 1, record))
+        except:
+            self.log.exception('Failed to read record %d' % (count + 1))
+        finally:
+            for i in xrange(self.concurrency):
+                self.jobs.put(None)
+            self.done.put(count)
+
+    def __call__(self, records):
+        '''
+        Results in the order they finish
+        '''
+        threads = [Thread(target=self.work) for i in xrange(self.concurrency)]
+        threads.append(Thread(target=self.feed, args=(records,)))
+        for t in threads:
+            t.daemon = True
+            t.start()
+        total, yielded = None, 0
+        while total is None or yielded < total:
+            result = self.done.get()
+            if isinstance(result, int):
+                total = result
+                continue
+            yielded += 1
+            yield result
+
+
+class QueryKeyStats(object):
+
+    '''
+    Counts how many of the searches of a batch repeat an earlier one, by
+    search url and by canonical query key
+    '''
+
+    def __init__(self, plugin, log):
+        self.plugin = plugin
+        self.log = log
+        self.searches = 0
+        self.urls = set()
+        self.keys = set()
+
+    def add(self, record):
+        args = query_args(record)
+        if args['identifiers'].get('cbdb'):
+            # Goes straight to the book page
+            return
+        url = self.plugin.create_query(self.log, **args)
+        if url is None:
+            return
+        self.searches += 1
+        self.urls.add(url)
+        self.keys.add(self.plugin.create_query_key(**args))
+
+    def repeat_rate(self, distinct):
+        return 100 * (1 - distinct / self.searches) if self.searches else 0
+
+    def summary(self):
+        return ('%d searches, repeated: %.1f%% by url, %.1f%% by canonical key' % (
+            self.searches, self.repeat_rate(len(self.urls)), self.repeat_rate(len(self.keys))))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+def main(args=sys.argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='calibre-debug -e bulk.py --',
+            description='Identify books from a JSONL or CSV file with the CBDB plugin')
+    parser.add_argument('input', help='JSONL or CSV file with title, authors, isbn, cbdb')
+    parser.add_argument('-o', '--output', help='JSONL file for the results, default stdout')
+    parser.add_argument('-j', '--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Books identified at the same time, default %(default)s')
+    parser.add_argument('-t', '--timeout', type=int, default=30,
+                        help='identify timeout in seconds, default %(default)s')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print the plugin log to stderr')
+    opts = parser.parse_args(args[1:])
+
+    log = ThreadSafeLog(level=ThreadSafeLog.DEBUG if opts.verbose else ThreadSafeLog.ERROR)
+    plugin = find_plugin()
+    bulk = BulkIdentify(plugin, max(1, opts.concurrency), opts.timeout, log)
+    key_stats = QueryKeyStats(plugin, log)
+    out = open(opts.output, 'wb') if opts.output else sys.stdout
+    start = time.time()
+    timings, found = [], 0
+    try:
+        for result in bulk(read_records(opts.input)):
+            out.write(json.dumps(result, ensure_ascii=False).encode('utf-8') + b'\n')
+            out.flush()
+            if result['seconds'] is not None:
+                timings.append(result['seconds'])
+            found += bool(result['results'])
+            key_stats.add(result['input'])
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.time() - start
+    count = len(timings)
+    print('%d books in %.1f s, %.2f books/s, %d with results' % (
+        count, elapsed, count / elapsed if elapsed else 0, found), file=sys.stderr)
+    print('identify seconds: median %.2f, p95 %.2f, max %.2f' % (
+        percentile(timings, 0.5), percentile(timings, 0.95), max(timings or [0])), file=sys.stderr)
+    print(key_stats.summary(), file=sys.stderr)
+    print('search cache: %d hits, %d misses, %d searches shared with a running one' % (
+        search_cache.hits, search_cache.misses, coalescer.shared), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
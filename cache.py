@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
+__docformat__ = 'restructuredtext cs'
+
+import json
+import os
+import sqlite3
+import time
+import zlib
+from threading import Lock
+
+from calibre.utils.config import config_dir
+
+# Book pages are refetched after this many seconds
+PAGE_CACHE_TTL = 7 * 24 * 60 * 60
+# Author pages change less often than the ratings on book pages
+BIBLIOGRAPHY_TTL = 30 * 24 * 60 * 60
+# Search results change whenever a book is added to CBDB
+SEARCH_CACHE_TTL = 24 * 60 * 60
+# Seconds an interactive request holds back the bulk and prefetch requests
+# of the other calibre processes, and how often they read the lease
+INTERACTIVE_LEASE = 10
+LEASE_CHECK_INTERVAL = 1
+# Seconds between deleting the rows that are past their TTL
+PRUNE_INTERVAL = 24 * 60 * 60
+PRUNE_QUERIES = (
+    ('DELETE FROM pages WHERE fetched < ?', PAGE_CACHE_TTL),
+    ('DELETE FROM parsed WHERE stored < ?', PAGE_CACHE_TTL),
+    ('DELETE FROM bibliographies WHERE stored < ?', BIBLIOGRAPHY_TTL),
+    ('DELETE FROM searches WHERE stored < ?', SEARCH_CACHE_TTL),
+    ('DELETE FROM leases WHERE expires < ?', 0),
+)
+
+
+class CacheDatabase(object):
+
+    '''
+    SQLite file in calibre's config folder holding the plugin's caches, so
+    every calibre process (GUI, metadata download jobs) shares them. Rows
+    are only checked against their TTL when read, the expired ones are
+    deleted on the first write and then once every PRUNE_INTERVAL.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(config_dir, 'plugins', 'CBDB_cache.sqlite')
+        self.lock = Lock()
+        self._conn = None
+        self.last_prune = 0
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS pages '
+                         '(url TEXT PRIMARY KEY, fetched REAL NOT NULL, body BLOB NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS parsed '
+                         '(cbdb_id TEXT PRIMARY KEY, stored REAL NOT NULL, record BLOB NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS bibliographies '
+                         '(author TEXT PRIMARY KEY, stored REAL NOT NULL, books BLOB NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS searches '
+                         '(key TEXT PRIMARY KEY, stored REAL NOT NULL, location TEXT NOT NULL, '
+                         'body BLOB NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS fingerprints '
+                         '(cbdb_id TEXT PRIMARY KEY, updated REAL NOT NULL, fingerprint TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS leases '
+                         '(name TEXT PRIMARY KEY, expires REAL NOT NULL)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def fetchone(self, sql, args):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchone()
+
+    def fetchall(self, sql, args):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def write(self, sql, args):
+        with self.lock:
+            self.conn.execute(sql, args)
+            self.conn.commit()
+            if time.time() - self.last_prune >= PRUNE_INTERVAL:
+                self._prune()
+
+    def _prune(self):
+        now = self.last_prune = time.time()
+        for sql, ttl in PRUNE_QUERIES:
+            self.conn.execute(sql, (now - ttl,))
+        self.conn.commit()
+
+
+class PageCache(object):
+
+    '''
+    Raw CBDB pages by url
+    '''
+
+    def __init__(self, db, ttl=PAGE_CACHE_TTL):
+        self.db = db
+        self.ttl = ttl
+
+    def get(self, url):
+        '''
+        Page body as bytes, or None when it is not cached or too old
+        '''
+        row = self.db.fetchone('SELECT fetched, body FROM pages WHERE url = ?', (url,))
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return zlib.decompress(bytes(row[1]))
+
+    def has(self, url):
+        row = self.db.fetchone('SELECT fetched FROM pages WHERE url = ?', (url,))
+        return row is not None and time.time() - row[0] <= self.ttl
+
+    def put(self, url, body):
+        self.db.write('INSERT OR REPLACE INTO pages (url, fetched, body) VALUES (?, ?, ?)',
+                      (url, time.time(), sqlite3.Binary(zlib.compress(body))))
+
+
+class ParsedCache(object):
+
+    '''
+    Fields parsed from each book page by CBDB id, stored as compressed JSON
+    so a hit rebuilds the result without touching the HTML
+    '''
+
+    def __init__(self, db, ttl=PAGE_CACHE_TTL):
+        self.db = db
+        self.ttl = ttl
+
+    def get(self, CBDB_id):
+        row = self.db.fetchone('SELECT stored, record FROM parsed WHERE cbdb_id = ?', (CBDB_id,))
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return json.loads(zlib.decompress(bytes(row[1])).decode('utf-8'))
+
+    def put(self, CBDB_id, record):
+        data = zlib.compress(json.dumps(record, separators=(',', ':')).encode('utf-8'))
+        self.db.write('INSERT OR REPLACE INTO parsed (cbdb_id, stored, record) VALUES (?, ?, ?)',
+                      (CBDB_id, time.time(), sqlite3.Binary(data)))
+
+
+class FingerprintStore(object):
+
+    '''
+    Fingerprint of the metadata on each book page last returned, by CBDB id
+    '''
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, CBDB_id):
+        row = self.db.fetchone('SELECT fingerprint FROM fingerprints WHERE cbdb_id = ?', (CBDB_id,))
+        return row[0] if row else None
+
+    def put(self, CBDB_id, fingerprint):
+        self.db.write('INSERT OR REPLACE INTO fingerprints (cbdb_id, updated, fingerprint) VALUES (?, ?, ?)',
+                      (CBDB_id, time.time(), fingerprint))
+
+
+class BibliographyCache(object):
+
+    '''
+    (title, url) of every book on an author's CBDB page, by matching.author_key.
+    Authors that were not found are not stored.
+    '''
+
+    def __init__(self, db, ttl=BIBLIOGRAPHY_TTL):
+        self.db = db
+        self.ttl = ttl
+
+    def get(self, key):
+        row = self.db.fetchone('SELECT stored, books FROM bibliographies WHERE author = ?', (key,))
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return json.loads(zlib.decompress(bytes(row[1])).decode('utf-8'))
+
+    def put(self, key, books):
+        data = zlib.compress(json.dumps(books, separators=(',', ':')).encode('utf-8'))
+        self.db.write('INSERT OR REPLACE INTO bibliographies (author, stored, books) VALUES (?, ?, ?)',
+                      (key, time.time(), sqlite3.Binary(data)))
+
+
+class SearchCache(object):
+
+    '''
+    Final url and body of CBDB searches by canonical query key, see
+    CBDB.create_query_key()
+    '''
+
+    def __init__(self, db, ttl=SEARCH_CACHE_TTL):
+        self.db = db
+        self.ttl = ttl
+        self.stats_lock = Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        row = self.db.fetchone('SELECT stored, location, body FROM searches WHERE key = ?', (key,))
+        hit = row is not None and time.time() - row[0] <= self.ttl
+        with self.stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not hit:
+            return None
+        return row[1], zlib.decompress(bytes(row[2]))
+
+    def put(self, key, location, body):
+        self.db.write('INSERT OR REPLACE INTO searches (key, stored, location, body) VALUES (?, ?, ?, ?)',
+                      (key, time.time(), location, sqlite3.Binary(zlib.compress(body))))
+
+
+class InteractiveLease(object):
+
+    '''
+    Taken by every interactive request, so the metadata download jobs in the
+    other calibre processes let the download the user waits for go first
+    '''
+
+    def __init__(self, db, duration=INTERACTIVE_LEASE):
+        self.db = db
+        self.duration = duration
+        self.lock = Lock()
+        self.checked = 0
+        self.expires = 0
+
+    def take(self):
+        expires = time.time() + self.duration
+        self.db.write('INSERT OR REPLACE INTO leases (name, expires) VALUES (?, ?)',
+                      ('interactive', expires))
+        with self.lock:
+            self.expires = expires
+
+    def held(self):
+        now = time.time()
+        with self.lock:
+            if now - self.checked >= LEASE_CHECK_INTERVAL:
+                self.checked = now
+                row = self.db.fetchone('SELECT expires FROM leases WHERE name = ?', ('interactive',))
+                self.expires = row[0] if row else 0
+            return self.expires > now
+
+
+cache_db = CacheDatabase()
+page_cache = PageCache(cache_db)
+parsed_cache = ParsedCache(cache_db)
+fingerprints = FingerprintStore(cache_db)
+bibliographies = BibliographyCache(cache_db)
+search_cache = SearchCache(cache_db)
+interactive_lease = InteractiveLease(cache_db)
@@ -8,6 +8,7 @@ __copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
 __docformat__ = 'restructuredtext cs'
 
 import copy
+from collections import namedtuple, OrderedDict
 from functools import partial
 try:
     from PyQt4 import QtGui
@@ -16,22 +17,39 @@ except ImportError:
 try:
     from PyQt4.Qt import (QTableWidgetItem, QVBoxLayout, Qt, QGroupBox, QTableWidget,
                           QCheckBox, QAbstractItemView, QHBoxLayout, QIcon,
-                          QInputDialog)
+                          QInputDialog, QLabel, QSpinBox, QPushButton)
 except ImportError:
     from PyQt5.Qt import (QTableWidgetItem, QVBoxLayout, Qt, QGroupBox, QTableWidget,
                           QCheckBox, QAbstractItemView, QHBoxLayout, QIcon,
-                          QInputDialog)
-from calibre.gui2 import get_current_db, question_dialog, error_dialog
+                          QInputDialog, QLabel, QSpinBox, QPushButton)
+from calibre.gui2 import get_current_db, question_dialog, error_dialog, info_dialog
 from calibre.gui2.complete2 import EditWithComplete
 from calibre.gui2.metadata.config import ConfigWidget as DefaultConfigWidget
 from calibre.utils.config import JSONConfig
 
-from calibre_plugins.CBDB.common_utils import ReadOnlyTableWidgetItem
+from calibre_plugins.CBDB.common_utils import ReadOnlyTableWidgetItem, KeyValueComboBox
 
 STORE_NAME = 'Options'
 KEY_GET_ALL_AUTHORS = 'getAllAuthors'
 KEY_GET_EDITIONS = 'getEditions'
 KEY_GENRE_MAPPINGS = 'genreMappings'
+KEY_MAX_SEARCH_RESULTS = 'maxSearchResults'
+KEY_SEARCH_ROWS_MODE = 'searchRowsMode'
+KEY_HEDGE_REQUESTS = 'hedgeRequests'
+KEY_INCREMENTAL_REFRESH = 'incrementalRefresh'
+KEY_PARSE_PROCESSES = 'parseProcesses'
+KEY_LOCAL_INDEX = 'localIndex'
+KEY_AUTHOR_BIBLIOGRAPHY = 'authorBibliography'
+KEY_SERIES_PREFETCH = 'seriesPrefetch'
+KEY_REFRESH_INTERACTIVE = 'refreshInteractive'
+
+SEARCH_ROWS_OFF = 'off'
+SEARCH_ROWS_PRELIMINARY = 'preliminary'
+SEARCH_ROWS_ONLY = 'only'
+SEARCH_ROWS_MODES = OrderedDict([
+    (SEARCH_ROWS_OFF, 'Download book pages only (default)'),
+    (SEARCH_ROWS_PRELIMINARY, 'Return search results first, then download book pages'),
+    (SEARCH_ROWS_ONLY, 'Search results only, no book pages (title, authors and id)')])
 
 DEFAULT_GENRE_MAPPINGS = {
                 'Anthologies': ['Anthologies'],
@@ -96,7 +114,16 @@ DEFAULT_GENRE_MAPPINGS = {
 DEFAULT_STORE_VALUES = {
     KEY_GET_EDITIONS: False,
     KEY_GET_ALL_AUTHORS: False,
-    KEY_GENRE_MAPPINGS: copy.deepcopy(DEFAULT_GENRE_MAPPINGS)
+    KEY_GENRE_MAPPINGS: copy.deepcopy(DEFAULT_GENRE_MAPPINGS),
+    KEY_MAX_SEARCH_RESULTS: 5,
+    KEY_SEARCH_ROWS_MODE: SEARCH_ROWS_OFF,
+    KEY_HEDGE_REQUESTS: False,
+    KEY_INCREMENTAL_REFRESH: False,
+    KEY_PARSE_PROCESSES: 0,
+    KEY_LOCAL_INDEX: False,
+    KEY_AUTHOR_BIBLIOGRAPHY: False,
+    KEY_SERIES_PREFETCH: False,
+    KEY_REFRESH_INTERACTIVE: False
 }
 
 # This is where all preferences for this plugin will be stored
@@ -105,6 +132,59 @@ plugin_prefs = JSONConfig('plugins/CBDB')
 # Set defaults
 plugin_prefs.defaults[STORE_NAME] = DEFAULT_STORE_VALUES
 
+# Lowercased CBDB genre -> tuple of calibre tags, compiled on first use and
+# rebuilt only when the stored mappings change
+_genre_tag_index = None
+
+
+def compile_genre_tag_index(genre_mappings):
+    return dict((genre.lower(), tuple(tags)) for (genre, tags) in genre_mappings.iteritems())
+
+
+def get_genre_tag_index():
+    global _genre_tag_index
+    index = _genre_tag_index
+    if index is None:
+        index = _genre_tag_index = compile_genre_tag_index(
+                plugin_prefs[STORE_NAME][KEY_GENRE_MAPPINGS])
+    return index
+
+
+def rebuild_genre_tag_index(genre_mappings=None):
+    global _genre_tag_index
+    if genre_mappings is None:
+        genre_mappings = plugin_prefs[STORE_NAME][KEY_GENRE_MAPPINGS]
+    _genre_tag_index = compile_genre_tag_index(genre_mappings)
+
+
+# Read-only view of the plugin options, taken once per identify and handed to
+# the workers so a whole run is consistent even if prefs are edited meanwhile
+PluginOptions = namedtuple('PluginOptions',
+        'get_editions get_all_authors genre_tag_index max_search_results '
+        'search_rows_mode hedge_requests incremental_refresh parse_processes '
+        'local_index author_bibliography series_prefetch refresh_interactive')
+
+
+def get_option(c, key):
+    # Options added in later versions are missing from already stored prefs
+    return c.get(key, DEFAULT_STORE_VALUES[key])
+
+
+def get_options_snapshot():
+    c = plugin_prefs[STORE_NAME]
+    return PluginOptions(get_editions=bool(c[KEY_GET_EDITIONS]),
+                         get_all_authors=bool(c[KEY_GET_ALL_AUTHORS]),
+                         genre_tag_index=get_genre_tag_index(),
+                         max_search_results=int(get_option(c, KEY_MAX_SEARCH_RESULTS)),
+                         search_rows_mode=get_option(c, KEY_SEARCH_ROWS_MODE),
+                         hedge_requests=bool(get_option(c, KEY_HEDGE_REQUESTS)),
+                         incremental_refresh=bool(get_option(c, KEY_INCREMENTAL_REFRESH)),
+                         parse_processes=int(get_option(c, KEY_PARSE_PROCESSES)),
+                         local_index=bool(get_option(c, KEY_LOCAL_INDEX)),
+                         author_bibliography=bool(get_option(c, KEY_AUTHOR_BIBLIOGRAPHY)),
+                         series_prefetch=bool(get_option(c, KEY_SERIES_PREFETCH)),
+                         refresh_interactive=bool(get_option(c, KEY_REFRESH_INTERACTIVE)))
+
 
 class GenreTagMappingsTableWidget(QTableWidget):
     def __init__(self, parent, all_tags):
@@ -231,11 +311,11 @@ class ConfigWidget(DefaultConfigWidget):
         other_group_box_layout = QVBoxLayout()
         other_group_box.setLayout(other_group_box_layout)
 
-        self.get_editions_checkbox = QCheckBox('Scan multiple editions for title/author searches (slower)', self)
-        self.get_editions_checkbox.setToolTip('When checked will perform an additional search to scan the top ranked\n'
-                                              'CBDB editions (if available) to exclude audiobook editions.\n'
-                                              'Without this enabled you will get a faster search, using the "best".\n'
-                                              'edition ranked by CBDB which can in some cases be an audiobook.')
+        self.get_editions_checkbox = QCheckBox('Skip audiobook editions when choosing the edition', self)
+        self.get_editions_checkbox.setToolTip('The publisher, date and ISBN are taken from the edition matching the ISBN\n'
+                                              'searched for, or when a book has a single edition, from that one.\n'
+                                              'When checked, editions whose note marks them as audiobooks (CD, MP3)\n'
+                                              'are left out when looking for that single edition.')
         self.get_editions_checkbox.setChecked(c[KEY_GET_EDITIONS])
         other_group_box_layout.addWidget(self.get_editions_checkbox)
         self.all_authors_checkbox = QCheckBox('Get all contributing authors (e.g. illustrators, series editors etc)', self)
@@ -254,6 +334,115 @@ class ConfigWidget(DefaultConfigWidget):
         self.all_authors_checkbox.setChecked(c[KEY_GET_ALL_AUTHORS])
         other_group_box_layout.addWidget(self.all_authors_checkbox)
 
+        max_results_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(max_results_layout)
+        max_results_label = QLabel('Maximum title/author search results to download details for:', self)
+        max_results_label.setToolTip('Search results are ranked by how closely they match the title and authors,\n'
+                                     'and only this many of the best ones have their book page downloaded.')
+        max_results_layout.addWidget(max_results_label)
+        self.max_results_spin = QSpinBox(self)
+        self.max_results_spin.setMinimum(1)
+        self.max_results_spin.setMaximum(50)
+        self.max_results_spin.setValue(get_option(c, KEY_MAX_SEARCH_RESULTS))
+        max_results_label.setBuddy(self.max_results_spin)
+        max_results_layout.addWidget(self.max_results_spin)
+        max_results_layout.addStretch(1)
+
+        search_rows_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(search_rows_layout)
+        search_rows_label = QLabel('Title/author search results:', self)
+        search_rows_label.setToolTip('The search results page already lists the title, authors and CBDB id of each book.\n'
+                                     'These can be returned straight away, before the slower book page downloads\n'
+                                     'refine them with the remaining fields, or on their own when only matching\n'
+                                     'books to CBDB ids is needed.')
+        search_rows_layout.addWidget(search_rows_label)
+        self.search_rows_combo = KeyValueComboBox(self, SEARCH_ROWS_MODES,
+                                                  get_option(c, KEY_SEARCH_ROWS_MODE))
+        search_rows_label.setBuddy(self.search_rows_combo)
+        search_rows_layout.addWidget(self.search_rows_combo)
+        search_rows_layout.addStretch(1)
+
+        self.hedge_requests_checkbox = QCheckBox('Send a second request when a book page or cover is unusually slow', self)
+        self.hedge_requests_checkbox.setToolTip('When a book page or cover download takes longer than almost all recent ones,\n'
+                                                'the same request is sent again and whichever answers first is used.\n'
+                                                'At most one in ten downloads is duplicated this way.')
+        self.hedge_requests_checkbox.setChecked(get_option(c, KEY_HEDGE_REQUESTS))
+        other_group_box_layout.addWidget(self.hedge_requests_checkbox)
+
+        self.incremental_refresh_checkbox = QCheckBox('Incremental refresh: skip books whose CBDB page has not changed', self)
+        self.incremental_refresh_checkbox.setToolTip('For books that already have a CBDB id, the book page is compared with the one\n'
+                                                     'last used for that book and no result is returned when the metadata on it\n'
+                                                     'is unchanged. Meant for refreshing ratings and comments of a whole library,\n'
+                                                     'downloads for a single book from the edit metadata dialog always return it.\n'
+                                                     'A page counts as used once its metadata is downloaded: if you cancel the\n'
+                                                     'download or reject its result, that book is skipped until its page changes.')
+        self.incremental_refresh_checkbox.setChecked(get_option(c, KEY_INCREMENTAL_REFRESH))
+        other_group_box_layout.addWidget(self.incremental_refresh_checkbox)
+
+        parse_processes_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(parse_processes_layout)
+        parse_processes_label = QLabel('Book page parser processes (0 = parse in the download threads):', self)
+        parse_processes_label.setToolTip('Parsing book pages takes most of the CPU time of a large metadata download and\n'
+                                         'the download threads cannot spread it over several cores. With a number of\n'
+                                         'processes set here, the pages are parsed in that many separate worker processes.\n'
+                                         'Only worth it for downloads of hundreds of books or more.')
+        parse_processes_layout.addWidget(parse_processes_label)
+        self.parse_processes_spin = QSpinBox(self)
+        self.parse_processes_spin.setMinimum(0)
+        self.parse_processes_spin.setMaximum(16)
+        self.parse_processes_spin.setValue(get_option(c, KEY_PARSE_PROCESSES))
+        parse_processes_label.setBuddy(self.parse_processes_spin)
+        parse_processes_layout.addWidget(self.parse_processes_spin)
+        parse_processes_layout.addStretch(1)
+
+        prewarm_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(prewarm_layout)
+        prewarm_button = QPushButton('Pre-warm cache for books with a CBDB id', self)
+        prewarm_button.setToolTip('Download the CBDB book pages of all books in this library that already have\n'
+                                  'a CBDB id in the background, slowly and behind any other CBDB lookups,\n'
+                                  'so later metadata downloads for them are answered from the cache.')
+        prewarm_button.clicked.connect(self.start_prewarm)
+        prewarm_layout.addWidget(prewarm_button)
+        prewarm_layout.addStretch(1)
+
+        self.refresh_interactive_checkbox = QCheckBox('Download the book page again when downloading metadata for a single book', self)
+        self.refresh_interactive_checkbox.setToolTip('Metadata downloaded from the edit metadata dialog always comes from the current\n'
+                                                     'CBDB book page and updates the cached one, instead of a page cached up to a\n'
+                                                     'week ago by pre-warming or an earlier download. Slower, pre-warmed pages are\n'
+                                                     'then not used for it. Bulk downloads always use the cache.')
+        self.refresh_interactive_checkbox.setChecked(get_option(c, KEY_REFRESH_INTERACTIVE))
+        other_group_box_layout.addWidget(self.refresh_interactive_checkbox)
+
+        local_index_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(local_index_layout)
+        self.local_index_checkbox = QCheckBox('Look up books in the local index before searching CBDB', self)
+        self.local_index_checkbox.setToolTip('Title/author and ISBN searches are first answered from an index of the\n'
+                                             'CBDB books already downloaded, and CBDB is only searched for books\n'
+                                             'not found there. Books downloaded while this is on are added to the index.')
+        self.local_index_checkbox.setChecked(get_option(c, KEY_LOCAL_INDEX))
+        local_index_layout.addWidget(self.local_index_checkbox)
+        index_button = QPushButton('Build local index', self)
+        index_button.setToolTip('Add all cached CBDB book pages to the local index, in the background.')
+        index_button.clicked.connect(self.start_index_build)
+        local_index_layout.addWidget(index_button)
+        local_index_layout.addStretch(1)
+
+        self.author_bibliography_checkbox = QCheckBox('Find books in the list of books of their author', self)
+        self.author_bibliography_checkbox.setToolTip('The CBDB page of each author is downloaded once and the books on it are\n'
+                                                     'remembered for a month. Books by an author already seen are then matched\n'
+                                                     'to that list instead of searching CBDB for their title. Best for libraries\n'
+                                                     'with many books by the same authors.')
+        self.author_bibliography_checkbox.setChecked(get_option(c, KEY_AUTHOR_BIBLIOGRAPHY))
+        other_group_box_layout.addWidget(self.author_bibliography_checkbox)
+
+        self.series_prefetch_checkbox = QCheckBox('Download the other books of a series in the background', self)
+        self.series_prefetch_checkbox.setToolTip('When a book turns out to be part of a series, the book pages of the other\n'
+                                                 'volumes are downloaded slowly in the background, behind any other CBDB\n'
+                                                 'lookups, so they are already cached when their turn in a large metadata\n'
+                                                 'download comes. At most 10 books per series and 200 per calibre session.')
+        self.series_prefetch_checkbox.setChecked(get_option(c, KEY_SERIES_PREFETCH))
+        other_group_box_layout.addWidget(self.series_prefetch_checkbox)
+
         self.edit_table.populate_table(c[KEY_GENRE_MAPPINGS])
 
     def commit(self):
@@ -262,7 +451,37 @@ class ConfigWidget(DefaultConfigWidget):
         new_prefs[KEY_GET_EDITIONS] = self.get_editions_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_GET_ALL_AUTHORS] = self.all_authors_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_GENRE_MAPPINGS] = self.edit_table.get_data()
+        new_prefs[KEY_MAX_SEARCH_RESULTS] = self.max_results_spin.value()
+        new_prefs[KEY_SEARCH_ROWS_MODE] = self.search_rows_combo.selected_key()
+        new_prefs[KEY_HEDGE_REQUESTS] = self.hedge_requests_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_INCREMENTAL_REFRESH] = self.incremental_refresh_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_PARSE_PROCESSES] = self.parse_processes_spin.value()
+        new_prefs[KEY_LOCAL_INDEX] = self.local_index_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_AUTHOR_BIBLIOGRAPHY] = self.author_bibliography_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_SERIES_PREFETCH] = self.series_prefetch_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_REFRESH_INTERACTIVE] = self.refresh_interactive_checkbox.checkState() == Qt.Checked
+        old_mappings = plugin_prefs[STORE_NAME][KEY_GENRE_MAPPINGS]
         plugin_prefs[STORE_NAME] = new_prefs
+        # Edits made in the table (including reset_to_defaults) only take
+        # effect here, so this is the one place the index needs rebuilding
+        if new_prefs[KEY_GENRE_MAPPINGS] != old_mappings:
+            rebuild_genre_tag_index(new_prefs[KEY_GENRE_MAPPINGS])
+
+    def start_prewarm(self):
+        from calibre.gui2.ui import get_gui
+        from calibre_plugins.CBDB.prewarm import start_prewarm
+        count = start_prewarm(self.plugin, get_current_db(), get_gui())
+        info_dialog(self, 'Pre-warming started',
+                    'Downloading CBDB book pages for %d books in the background.\n'
+                    'Stop the CBDB pre-warm job in the Jobs list to cancel it.' % count,
+                    show=True)
+
+    def start_index_build(self):
+        from calibre_plugins.CBDB.index import start_index_build
+        start_index_build()
+        info_dialog(self, 'Building local index',
+                    'Adding the cached CBDB book pages to the local index in the background.',
+                    show=True)
 
     def add_mapping(self):
         new_genre_name, ok = QInputDialog.getText(self, 'Add new mapping',
@@ -0,0 +1,652 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
+__docformat__ = 'restructuredtext cs'
+
+import socket
+import sys
+import time
+from collections import deque
+from Queue import Queue, Empty
+from threading import Condition, Event, Lock, Thread, local, enumerate as all_threads
+
+from calibre.utils.config import JSONConfig
+
+# Consecutive failed requests after which CBDB is considered down
+FAILURE_THRESHOLD = 5
+# Seconds to fail fast for before a single probe request is let through
+COOL_DOWN = 60
+
+# A hedge is sent when a read has not answered within this percentile of the
+# recent latencies, but never sooner than HEDGE_MIN_DELAY seconds
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_DELAY = 0.5
+# Share of reads that may be duplicated, and how many hedges can be saved up
+HEDGE_BUDGET = 0.1
+HEDGE_BURST = 5
+# Recent latencies kept, and how many are needed before hedging starts
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+
+# Requests allowed in flight at once: grows by one per
+# limit's worth of fast answers, halves on a timeout, connection error or 5xx
+CONCURRENCY_INITIAL = 4
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = 16
+CONCURRENCY_DECREASE = 0.5
+# Answers slower than this (seconds) do not raise the limit
+CONCURRENCY_SLOW_LATENCY = 5
+# Failures within this many seconds of a cut are the same congestion event
+CONCURRENCY_DECREASE_INTERVAL = 2
+
+# Request priority classes, lower goes first. A waiting request moves up one
+# class every PRIORITY_AGING seconds so bulk work is never starved.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_PREFETCH = 2
+PRIORITY_AGING = 10
+
+# Seconds between checks whether an interactive request still holds back
+# the requests of this process
+LEASE_POLL = 0.5
+# calibre runs the metadata download of the edit metadata dialog in a worker
+# process, from these functions
+INTERACTIVE_ENTRY_POINTS = frozenset(['single_identify', 'single_covers'])
+
+# Endpoint classes latencies are kept for
+ENDPOINT_SEARCH = 'search'
+ENDPOINT_DETAIL = 'detail'
+ENDPOINT_COVER = 'cover'
+ENDPOINT_OTHER = 'other'
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 12, 20, 30, 45, 60, 90)
+# Timeout is this percentile of the endpoint's latencies times the factor,
+# within the bounds, once there are enough samples to go by
+TIMEOUT_PERCENTILE = 0.99
+TIMEOUT_FACTOR = 2
+TIMEOUT_MIN = 5
+TIMEOUT_MAX = 90
+TIMEOUT_MIN_SAMPLES = 50
+# Counts are halved past this many samples so old latencies fade out
+HISTOGRAM_DECAY_AT = 5000
+# Seconds between saving the histograms
+HISTOGRAM_SAVE_INTERVAL = 60
+
+
+class CircuitOpenError(IOError):
+
+    '''
+    Raised instead of making a request while CBDB is considered down
+    '''
+
+
+def is_outage(e):
+    '''
+    Timeouts, connection errors and 5xx responses count against CBDB, any
+    other HTTP error means the server answered
+    '''
+    if isinstance(e, CircuitOpenError):
+        return False
+    if callable(getattr(e, 'getcode', None)):
+        code = e.getcode()
+        return code is None or code >= 500
+    return isinstance(e, (IOError, socket.error))
+
+
+def is_timeout(e):
+    return isinstance(e, socket.timeout) or isinstance(getattr(e, 'reason', None), socket.timeout)
+
+
+class CircuitBreaker(object):
+
+    '''
+    Process wide view of whether CBDB is reachable. After FAILURE_THRESHOLD
+    consecutive failures all requests fail fast for COOL_DOWN seconds, then a
+    single probe is let through and its outcome decides whether to open
+    traffic again or wait another cool down.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, cool_down=COOL_DOWN):
+        self.failure_threshold = failure_threshold
+        self.cool_down = cool_down
+        self.lock = Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probe_in_flight = False
+
+    def before_request(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.cool_down - time.time()
+                if remaining > 0:
+                    raise CircuitOpenError('CBDB is not responding, retrying in %d seconds' % remaining)
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self.probe_in_flight:
+                    raise CircuitOpenError('CBDB is not responding, waiting for a probe request')
+                self.probe_in_flight = True
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        '''
+        Returns True when this failure opened the circuit
+        '''
+        with self.lock:
+            self.probe_in_flight = False
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                return True
+            return False
+
+
+class LatencyTracker(object):
+
+    '''
+    Sliding windows of recent request latencies in seconds, one per endpoint
+    class so fast cover reads do not set the pace for book pages
+    '''
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self.lock = Lock()
+        self.size = size
+        self.samples = {}
+
+    def add(self, endpoint, latency):
+        with self.lock:
+            samples = self.samples.get(endpoint)
+            if samples is None:
+                samples = self.samples[endpoint] = deque(maxlen=self.size)
+            samples.append(latency)
+
+    def percentile(self, endpoint, p, min_samples=LATENCY_MIN_SAMPLES):
+        with self.lock:
+            samples = self.samples.get(endpoint, ())
+            if len(samples) < min_samples:
+                return None
+            ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+class HedgeBudget(object):
+
+    '''
+    Every read earns HEDGE_BUDGET of a hedge and every hedge spends a whole
+    one, so no more than that share of reads is ever duplicated
+    '''
+
+    def __init__(self, ratio=HEDGE_BUDGET, burst=HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.lock = Lock()
+        self.tokens = 0.0
+
+    def earn(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def spend(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class _Ticket(object):
+
+    __slots__ = ('priority', 'since')
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.since = time.time()
+
+
+class ConcurrencyLimiter(object):
+
+    '''
+    Additive increase / multiplicative decrease limit on the number of
+    requests in flight across all workers. Free slots go to the waiting
+    request with the best priority class, taking the time waited into account.
+    '''
+
+    def __init__(self, initial=CONCURRENCY_INITIAL, minimum=CONCURRENCY_MIN,
+                 maximum=CONCURRENCY_MAX):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.cond = Condition(Lock())
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.waiting = []
+
+    def _next_ticket(self):
+        now = time.time()
+        return min(self.waiting, key=lambda t: (t.priority - (now - t.since) / PRIORITY_AGING, t.since))
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE):
+        with self.cond:
+            ticket = _Ticket(priority)
+            self.waiting.append(ticket)
+            try:
+                while self.in_flight >= int(self.limit) or self._next_ticket() is not ticket:
+                    # Wake up now and then, waiting changes the order
+                    self.cond.wait(PRIORITY_AGING)
+            finally:
+                self.waiting.remove(ticket)
+            self.in_flight += 1
+            # There may be a slot free for the next one in line as well
+            self.cond.notify_all()
+
+    def release(self, healthy):
+        '''
+        healthy is True for a fast answer, False for an outage and None when
+        the answer says nothing about CBDB's load. Returns the new limit if
+        it changed.
+        '''
+        with self.cond:
+            # Only grow a limit that is actually being used
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            old = int(self.limit)
+            if healthy and saturated:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif healthy is False:
+                now = time.time()
+                if now - self.last_decrease >= CONCURRENCY_DECREASE_INTERVAL:
+                    self.last_decrease = now
+                    self.limit = max(self.minimum, self.limit * CONCURRENCY_DECREASE)
+            self.cond.notify_all()
+            if int(self.limit) != old:
+                return int(self.limit)
+
+
+def endpoint_for(url):
+    if '/vyhledavani.php' in url:
+        return ENDPOINT_SEARCH
+    if '/kniha-' in url:
+        return ENDPOINT_DETAIL
+    if url.lower().rpartition('.')[2] in ('jpg', 'jpeg', 'png', 'gif'):
+        return ENDPOINT_COVER
+    return ENDPOINT_OTHER
+
+
+class LatencyHistograms(object):
+
+    '''
+    Per endpoint latency histograms of the successful requests, persisted
+    between calibre sessions, from which the request timeouts are derived.
+    Timed out requests only say the latency was above the timeout used, they
+    are counted apart. When more of them time out than the percentile
+    allows for, the timeout is raised past what the histogram shows.
+    The GUI and the worker processes share the file, each adds the counts it
+    collected since its last save to what is stored.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.store = JSONConfig('plugins/CBDB_latency')
+        self.histograms, self.censored = self._stored()
+        # Counts since the last save, not in the store yet
+        self.new_histograms = {}
+        self.new_censored = {}
+        self.last_save = time.time()
+
+    def _stored(self):
+        histograms = {}
+        for endpoint, counts in self.store.get('histograms', {}).iteritems():
+            if len(counts) == len(LATENCY_BUCKETS) + 1:
+                histograms[endpoint] = list(counts)
+        return histograms, dict(self.store.get('censored', {}))
+
+    def _decay(self, histograms, censored, endpoint):
+        counts = histograms.get(endpoint) or []
+        if sum(counts) + censored.get(endpoint, 0) > HISTOGRAM_DECAY_AT:
+            counts[:] = [c // 2 for c in counts]
+            if endpoint in censored:
+                censored[endpoint] //= 2
+
+    def _maybe_save(self):
+        if time.time() - self.last_save < HISTOGRAM_SAVE_INTERVAL:
+            return
+        self.last_save = time.time()
+        self.store.refresh()
+        histograms, censored = self._stored()
+        for endpoint, new in self.new_histograms.iteritems():
+            counts = histograms.setdefault(endpoint, [0] * (len(LATENCY_BUCKETS) + 1))
+            counts[:] = [c + n for c, n in zip(counts, new)]
+        for endpoint, new in self.new_censored.iteritems():
+            censored[endpoint] = censored.get(endpoint, 0) + new
+        for endpoint in set(histograms) | set(censored):
+            self._decay(histograms, censored, endpoint)
+        self.histograms, self.censored = histograms, censored
+        self.new_histograms, self.new_censored = {}, {}
+        self.store['histograms'] = histograms
+        self.store['censored'] = censored
+
+    def add(self, endpoint, latency):
+        i = 0
+        while i < len(LATENCY_BUCKETS) and latency > LATENCY_BUCKETS[i]:
+            i += 1
+        with self.lock:
+            for histograms in (self.histograms, self.new_histograms):
+                histograms.setdefault(endpoint, [0] * (len(LATENCY_BUCKETS) + 1))[i] += 1
+            self._decay(self.histograms, self.censored, endpoint)
+            self._maybe_save()
+
+    def add_timeout(self, endpoint):
+        with self.lock:
+            for censored in (self.censored, self.new_censored):
+                censored[endpoint] = censored.get(endpoint, 0) + 1
+            self._decay(self.histograms, self.censored, endpoint)
+            self._maybe_save()
+
+    def percentile(self, endpoint, p, min_samples=TIMEOUT_MIN_SAMPLES):
+        with self.lock:
+            counts = list(self.histograms.get(endpoint, ()))
+        total = sum(counts)
+        if total < min_samples:
+            return None
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if seen >= p * total:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else TIMEOUT_MAX
+        return TIMEOUT_MAX
+
+    def censored_share(self, endpoint):
+        with self.lock:
+            total = sum(self.histograms.get(endpoint, ()))
+            censored = self.censored.get(endpoint, 0)
+        return censored / (total + censored) if censored else 0
+
+    def timeout_for(self, url, default):
+        endpoint = endpoint_for(url)
+        p = self.percentile(endpoint, TIMEOUT_PERCENTILE)
+        if p is None:
+            return default
+        timeout = max(TIMEOUT_MIN, min(TIMEOUT_MAX, p * TIMEOUT_FACTOR))
+        if self.censored_share(endpoint) > 1 - TIMEOUT_PERCENTILE:
+            # The percentile is among the timed out requests, beyond what
+            # the histogram shows, so a slow but working CBDB is not cut off
+            timeout = min(TIMEOUT_MAX, max(default, timeout * 2))
+        return timeout
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.result = self.error = None
+
+
+class Coalescer(object):
+
+    '''
+    Concurrent calls with the same key share a single call of the function,
+    the callers that came later get its result or exception
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+        # Calls that were answered by another caller's call
+        self.shared = 0
+
+    def __call__(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+breaker = CircuitBreaker()
+latency_histograms = LatencyHistograms()
+read_latencies = LatencyTracker()
+hedge_budget = HedgeBudget()
+limiter = ConcurrencyLimiter()
+coalescer = Coalescer()
+
+_context = local()
+
+
+def interactive_process():
+    '''
+    True in the calibre GUI and in the worker process calibre starts for the
+    metadata download of a single book, where the user waits for the result.
+    The bulk metadata download runs in other worker processes.
+    '''
+    if 'calibre.gui2.ui' in sys.modules:
+        from calibre.gui2.ui import get_gui
+        if get_gui() is not None:
+            return True
+    worker = sys.modules.get('calibre.ebooks.metadata.sources.worker')
+    if worker is None:
+        return False
+    main = [t for t in all_threads() if t.name == 'MainThread']
+    frame = sys._current_frames().get(main[0].ident) if main else None
+    while frame is not None:
+        if (frame.f_code.co_name in INTERACTIVE_ENTRY_POINTS and
+                frame.f_globals.get('__name__') == worker.__name__):
+            return True
+        frame = frame.f_back
+    return False
+
+
+def current_priority():
+    '''
+    Priority class of requests made from this thread. Unless changed with
+    set_priority() interactive when the user waits for the result, see
+    interactive_process(), bulk otherwise.
+    '''
+    priority = getattr(_context, 'priority', None)
+    if priority is None:
+        priority = PRIORITY_INTERACTIVE if interactive_process() else PRIORITY_BULK
+    return priority
+
+
+def set_priority(priority):
+    _context.priority = priority
+
+
+def is_interactive(priority):
+    '''
+    True for a metadata download the user is waiting on, pre-warming and the
+    bulk download run at lower priorities
+    '''
+    return priority == PRIORITY_INTERACTIVE and interactive_process()
+
+
+def _yield_to_interactive(priority):
+    '''
+    The limiter only orders the requests of one process. An interactive
+    request takes a lease in the shared cache database, bulk and prefetch
+    requests of every process wait while it is held, but no longer than
+    they would wait behind it in ConcurrencyLimiter.acquire().
+    '''
+    from calibre_plugins.CBDB.cache import interactive_lease
+    # The lease is only a hint, a busy database must not fail the request
+    try:
+        if priority == PRIORITY_INTERACTIVE:
+            if interactive_process():
+                interactive_lease.take()
+            return
+        give_up = time.time() + (priority - PRIORITY_INTERACTIVE) * PRIORITY_AGING
+        while time.time() < give_up and interactive_lease.held():
+            time.sleep(LEASE_POLL)
+    except Exception:
+        pass
+
+
+def _request(browser, url, timeout):
+    '''
+    A single request, made while holding a limiter slot. Returns the final
+    url, the body and the latency, the body is read within the slot too. The
+    outcome is recorded by the caller, see _record_success() and
+    _record_failure().
+    '''
+    start = time.time()
+    response = browser.open_novisit(url, timeout=timeout)
+    body = response.read()
+    return response.geturl(), body, time.time() - start
+
+
+def _record_success(url, latency):
+    '''
+    Returns how healthy the answer was as taken by ConcurrencyLimiter.release()
+    '''
+    breaker.record_success()
+    endpoint = endpoint_for(url)
+    latency_histograms.add(endpoint, latency)
+    read_latencies.add(endpoint, latency)
+    return latency <= CONCURRENCY_SLOW_LATENCY or None
+
+
+def _record_failure(url, e, log):
+    if not is_outage(e):
+        breaker.record_success()
+        return None
+    if is_timeout(e):
+        latency_histograms.add_timeout(endpoint_for(url))
+    if breaker.record_failure() and log is not None:
+        log.error('CBDB failed %d times in a row, not contacting it for %d seconds' %
+                  (breaker.failures, breaker.cool_down))
+    return False
+
+
+def _release(healthy, log):
+    limit = limiter.release(healthy)
+    if limit is not None and log is not None:
+        log.info('CBDB concurrency limit is now %d' % limit)
+
+
+def _fetch(browser, url, timeout, log, read, priority):
+    breaker.before_request()
+    _yield_to_interactive(priority)
+    timeout = latency_histograms.timeout_for(url, timeout)
+    limiter.acquire(priority)
+    healthy = None
+    try:
+        location, body, latency = _request(browser, url, timeout)
+        healthy = _record_success(url, latency)
+        return body if read else (location, body)
+    except Exception as e:
+        healthy = _record_failure(url, e, log)
+        raise
+    finally:
+        _release(healthy, log)
+
+
+def _hedged_read(browser, url, timeout, log, priority):
+    p = read_latencies.percentile(endpoint_for(url), HEDGE_PERCENTILE)
+    hedge_budget.earn()
+    if p is None:
+        return _fetch(browser, url, timeout, log, True, priority)
+    delay = max(HEDGE_MIN_DELAY, p)
+
+    # Both requests share one slot, taken before anything is sent: the
+    # hedge budget bounds the duplicates, and the delay starts once the
+    # first request is on its way, a wait for a slot is not a slow answer.
+    # The slot is released with the first answer, and only its outcome is
+    # recorded, a request that is still running then is abandoned.
+    breaker.before_request()
+    _yield_to_interactive(priority)
+    timeout = latency_histograms.timeout_for(url, timeout)
+    limiter.acquire(priority)
+    healthy = None
+    try:
+        answers = Queue()
+
+        def attempt(br):
+            try:
+                answers.put((True, _request(br, url, timeout)))
+            except Exception as e:
+                answers.put((False, e))
+
+        def start(br):
+            t = Thread(target=attempt, args=(br,))
+            t.daemon = True
+            t.start()
+
+        start(browser)
+        attempts = 1
+        try:
+            ok, value = answers.get(timeout=delay)
+        except Empty:
+            if hedge_budget.spend():
+                if log is not None:
+                    log.info('No answer after %.1f seconds, sending a second request for: %r' % (delay, url))
+                start(browser.clone_browser())
+                attempts = 2
+            ok, value = answers.get()
+            attempts -= 1
+            if not ok and attempts:
+                # The other request may still succeed
+                ok, value = answers.get()
+        if ok:
+            location, body, latency = value
+            healthy = _record_success(url, latency)
+            return body
+        healthy = _record_failure(url, value, log)
+        raise value
+    finally:
+        _release(healthy, log)
+
+
+def open_url(browser, url, timeout, log=None, priority=None):
+    '''
+    Open url through the circuit breaker and return the final url, after any
+    redirect, and the body. timeout is only used until enough latencies have
+    been seen for url's endpoint.
+    '''
+    if priority is None:
+        priority = current_priority()
+    return _fetch(browser, url, timeout, log, False, priority)
+
+
+def read_url(browser, url, timeout, log=None, hedge=False, priority=None):
+    '''
+    Open url through the circuit breaker and return the response body. With
+    hedge a duplicate request is sent when the first one is slower than
+    usual, and the body of whichever answers first is returned. priority
+    defaults to the priority class of the calling thread.
+    '''
+    if priority is None:
+        priority = current_priority()
+    if hedge:
+        return _hedged_read(browser, url, timeout, log, priority)
+    return _fetch(browser, url, timeout, log, True, priority)
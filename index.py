@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
+__docformat__ = 'restructuredtext cs'
+
+import json
+import os
+import re
+import sqlite3
+import zlib
+from threading import Thread
+
+from calibre.ebooks.metadata import check_isbn
+from calibre.utils.logging import default_log
+
+if __name__ == '__main__':
+    # Run as a script, calibre_plugins.CBDB can only be imported once the
+    # plugins are loaded
+    import calibre.customize.ui  # noqa
+
+import calibre_plugins.CBDB as base
+from calibre_plugins.CBDB.cache import cache_db, page_cache
+from calibre_plugins.CBDB.matching import normalize_text
+
+# Candidates read from the index per lookup, before they are scored
+INDEX_CANDIDATES = 50
+
+# Enough of a book page for the index, see Worker.parsed_groups()
+INDEX_FIELDS = frozenset(['title', 'authors', 'series', 'identifier:isbn'])
+
+
+def _words(text):
+    return re.findall(r'\w+', normalize_text(text), re.UNICODE)
+
+
+class BookIndex(object):
+
+    '''
+    Full text index of known CBDB books in the cache database, so identify
+    can find them without searching CBDB. The text is stored normalized (see
+    matching.normalize_text) and the rowid is the CBDB id. The url of each
+    book is the one its page is cached under.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self._ready = None
+
+    def ready(self):
+        '''
+        False when this SQLite has no FTS4
+        '''
+        if self._ready is None:
+            try:
+                self.db.write('CREATE VIRTUAL TABLE IF NOT EXISTS book_index '
+                              'USING fts4(url, title, authors, series, isbns)', ())
+                self._ready = True
+            except sqlite3.OperationalError:
+                self._ready = False
+        return self._ready
+
+    def add(self, record, url=None):
+        try:
+            docid = int(record['cbdb_id'])
+        except (TypeError, ValueError):
+            return
+        if 'editions' in record:
+            isbns = set(check_isbn(e[2]) for e in record['editions'])
+            isbns = ' '.join(sorted(i for i in isbns if i))
+        else:
+            # Parsed without the releases table, keep what is known
+            row = self.db.fetchone('SELECT isbns FROM book_index WHERE docid = ?', (docid,))
+            isbns = row[0] if row else ''
+        url = url or base.BASE_BOOK_URL % (base.BASE_URL, docid)
+        self.db.write('INSERT OR REPLACE INTO book_index (docid, url, title, authors, series, isbns) '
+                      'VALUES (?, ?, ?, ?, ?, ?)',
+                      (docid, url, normalize_text(record['title']),
+                       normalize_text(', '.join(record['authors'])),
+                       normalize_text(record.get('series') or ''), isbns))
+
+    def find_isbn(self, isbn):
+        rows = self.db.fetchall('SELECT url FROM book_index WHERE isbns MATCH ?', (isbn,))
+        return [r[0] for r in rows]
+
+    def find(self, title_tokens, author_tokens, limit=INDEX_CANDIDATES):
+        '''
+        (url, title, authors) of the books with all title tokens, or
+        with all author tokens when there is no title
+        '''
+        column, tokens = ('title', title_tokens) if title_tokens else ('authors', author_tokens)
+        terms = ['%s:%s' % (column, w) for t in tokens for w in _words(t)]
+        if not terms:
+            return []
+        return self.db.fetchall('SELECT url, title, authors FROM book_index '
+                                'WHERE book_index MATCH ? LIMIT ?', (' '.join(terms), limit))
+
+    def __len__(self):
+        return self.db.fetchone('SELECT count(*) FROM book_index', ())[0]
+
+
+book_index = BookIndex(cache_db)
+
+
+def crawled_pages(paths):
+    '''
+    (url, body) of saved CBDB book pages, found by the kniha-<id> in their
+    file names
+    '''
+    for path in paths:
+        if os.path.isdir(path):
+            files = (os.path.join(d, f) for d, dirs, names in os.walk(path) for f in names)
+        else:
+            files = [path]
+        for f in files:
+            m = re.search(r'kniha-(\d+)', os.path.basename(f))
+            if m:
+                with open(f, 'rb') as page:
+                    yield base.BASE_BOOK_URL % (base.BASE_URL, m.group(1)), page.read()
+
+
+def build_index(log=default_log, paths=()):
+    '''
+    Adds every cached book page, parsed record and the saved pages in paths
+    to the index. Saved pages are also put in the page cache, so identify can
+    use them without downloading. Returns the number of books added.
+    '''
+    from calibre_plugins.CBDB.parsing import PageParser, ParseOptions
+    if not book_index.ready():
+        log.error('This SQLite has no full text search, the local index cannot be built')
+        return 0
+    parser = PageParser(None, log, ParseOptions(False), INDEX_FIELDS)
+    seen = set()
+
+    def add_pages(pages, cache=False):
+        for url, body in pages:
+            parser.url = url
+            try:
+                record = parser.parse_page(body)[0]
+            except:
+                log.exception('Failed to parse book page for the index: %r' % url)
+                continue
+            if record is not None:
+                if cache:
+                    page_cache.put(url, body)
+                book_index.add(record, url)
+                seen.add(record['cbdb_id'])
+
+    add_pages(crawled_pages(paths), cache=True)
+
+    def cached(sql, key):
+        # Keys first, the bodies one by one, so the index can be written
+        # to meanwhile
+        for row in cache_db.fetchall(key, ()):
+            data = cache_db.fetchone(sql, row)
+            if data is not None:
+                yield row[0], zlib.decompress(bytes(data[0]))
+
+    add_pages(cached('SELECT body FROM pages WHERE url = ?', 'SELECT url FROM pages'))
+    for CBDB_id, data in cached('SELECT record FROM parsed WHERE cbdb_id = ?', 'SELECT cbdb_id FROM parsed'):
+        if CBDB_id not in seen:
+            book_index.add(json.loads(data.decode('utf-8')))
+            seen.add(CBDB_id)
+    log.info('Local index: %d books added, %d in total' % (len(seen), len(book_index)))
+    return len(seen)
+
+
+def start_index_build(log=None, paths=()):
+    t = Thread(target=build_index, args=(log or default_log, paths))
+    t.daemon = True
+    t.start()
+    return t
+
+
+if __name__ == '__main__':
+    # To add saved book pages to the index use:
+    # calibre-debug -e index.py -- [files or folders...]
+    import sys
+    build_index(paths=sys.argv[1:])
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
+__docformat__ = 'restructuredtext cs'
+
+import re
+import unicodedata
+
+from calibre.utils.icu import lower
+
+# Folded strings remembered, enough for the titles and authors of a large
+# library so a bulk run never has to start over. An LRU costs more per hit in
+# pure Python than the translate() it saves.
+FOLD_CACHE_SIZE = 100000
+
+# Weights used to rank search result rows
+TITLE_WEIGHT = 2.0
+AUTHOR_WEIGHT = 1.0
+EXACT_TITLE_BONUS = 1.0
+RATING_WEIGHT = 0.5
+MAX_RATING_ICON = 5
+
+
+def _fold_char(c):
+    return ''.join(d for d in unicodedata.normalize('NFD', c) if unicodedata.category(d) != 'Mn')
+
+
+class _FoldTable(dict):
+
+    '''
+    unicode.translate() table mapping accented characters to their base form.
+    Czech/Slovak and the Latin blocks are filled in up front, anything else is
+    worked out on first sight and remembered.
+    '''
+
+    def __missing__(self, cp):
+        c = unichr(cp)
+        folded = _fold_char(c)
+        self[cp] = value = cp if folded == c else (folded or None)
+        return value
+
+
+def _build_fold_table():
+    table = _FoldTable()
+    # Latin-1 Supplement, Latin Extended-A/B, Latin Extended Additional
+    for start, end in ((0x00C0, 0x0250), (0x1E00, 0x1F00)):
+        for cp in xrange(start, end):
+            table[cp]
+    # Combining diacritical marks left over in already decomposed input
+    for cp in xrange(0x0300, 0x0370):
+        table[cp]
+    return table
+
+
+_fold_table = _build_fold_table()
+_fold_cache = {}
+
+
+def fold_accents(text):
+    '''
+    Same result as stripping the combining marks after NFD normalization,
+    but done with a single translate() and memoized per string.
+    '''
+    if not text:
+        return text
+    try:
+        return _fold_cache[text]
+    except KeyError:
+        pass
+    folded = text.translate(_fold_table)
+    if len(_fold_cache) >= FOLD_CACHE_SIZE:
+        _fold_cache.clear()
+    _fold_cache[text] = folded
+    return folded
+
+
+def normalize_text(text):
+    '''
+    Lowercased and accent folded form used for all matching
+    '''
+    return fold_accents(lower(text)) if text else ''
+
+
+def canonical_words(tokens, ordered=True, accents=False):
+    '''
+    Normalized words of tokens, joined by single spaces. Sorted unless
+    ordered, for names whose parts come in either order. With accents the
+    words are only lowercased.
+    '''
+    words = []
+    for t in tokens:
+        t = (lower(t) if t else '') if accents else normalize_text(t)
+        words.extend(re.findall(r'\w+', t, re.UNICODE))
+    return ' '.join(words if ordered else sorted(words))
+
+
+def author_key(author):
+    '''
+    Same for "Karel Čapek", "Čapek, Karel" and "karel capek"
+    '''
+    return canonical_words([author], ordered=False)
+
+
+class TokenMatcher(object):
+
+    '''
+    Checks search result rows against the query title/author tokens. The
+    tokens are normalized once per identify and every row once per check,
+    which covers both the accented and the accent stripped comparison.
+    '''
+
+    def __init__(self, title_tokens, author_tokens, title=None):
+        self.title_tokens = self._normalize_tokens(title_tokens)
+        self.author_tokens = self._normalize_tokens(author_tokens)
+        self.title = normalize_text(title).strip()
+
+    def _normalize_tokens(self, tokens):
+        normalized = []
+        for t in tokens:
+            t = normalize_text(t)
+            if t and t not in normalized:
+                normalized.append(t)
+        return tuple(normalized)
+
+    def _any_in(self, tokens, text):
+        if not tokens:
+            return True
+        for t in tokens:
+            if t in text:
+                return True
+        return False
+
+    def _overlap(self, tokens, text):
+        return sum(1 for t in tokens if t in text) / len(tokens) if tokens else 1.0
+
+    def match(self, title, authors):
+        return (self._any_in(self.title_tokens, normalize_text(title)) and
+                self._any_in(self.author_tokens, normalize_text(' '.join(authors))))
+
+    def has_all_authors(self, authors):
+        '''
+        True when authors have every author token of the query
+        '''
+        return (bool(self.author_tokens) and
+                self._overlap(self.author_tokens, normalize_text(' '.join(authors))) == 1)
+
+    def is_exact(self, title, authors):
+        '''
+        True for the exact title of the query with all of its author tokens
+        '''
+        if not self.title:
+            return False
+        return normalize_text(title).strip() == self.title and self.has_all_authors(authors)
+
+    def score(self, title, authors, rating=None):
+        '''
+        Similarity of a search row to the query, or None when the row is not a
+        match at all. Rows are ranked on title/author token overlap, with a
+        bonus for an exact title and a small one for the row's rating icon.
+        '''
+        ntitle = normalize_text(title)
+        title_overlap = self._overlap(self.title_tokens, ntitle)
+        author_overlap = self._overlap(self.author_tokens, normalize_text(' '.join(authors)))
+        if not title_overlap or not author_overlap:
+            return None
+        score = TITLE_WEIGHT * title_overlap + AUTHOR_WEIGHT * author_overlap
+        if self.title and ntitle.strip() == self.title:
+            score += EXACT_TITLE_BONUS
+        if rating:
+            score += RATING_WEIGHT * min(rating, MAX_RATING_ICON) / MAX_RATING_ICON
+        return score
+
+
+def parse_rating_icon(src):
+    '''
+    Rating shown in a search row, taken from the number in its icon file name
+    '''
+    if not src:
+        return None
+    m = re.search(r'(\d+)\D*$', src.rpartition('/')[2])
+    if m:
+        return int(m.group(1))
+
+
+if __name__ == '__main__':  # benchmark
+    # To run the benchmark use:
+    # calibre-debug -e matching.py [titles.txt | --synthetic N]
+    # Without a file the titles and authors of the current library are used,
+    # --synthetic uses N random Czech strings generated from a fixed seed.
+    import random
+    import sys
+    import timeit
+
+    def strip_accents_nfd(inp):
+        # The original CBDB.strip_accents implementation
+        return ''.join((c for c in unicodedata.normalize('NFD', inp) if unicodedata.category(c) != 'Mn'))
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--synthetic':
+        rnd = random.Random(1)
+        alphabet = 'abcdefghijklmnopqrstuvwxyzáčďéěíňóřšťúůýž '
+        texts = [''.join(rnd.choice(alphabet) for i in xrange(rnd.randint(8, 40)))
+                 for j in xrange(int(sys.argv[2]))]
+    elif len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            texts = [l.decode('utf-8').strip() for l in f if l.strip()]
+    else:
+        from calibre.library import db
+        cache = db().new_api
+        texts = []
+        for book_id in cache.all_book_ids():
+            texts.append(cache.field_for('title', book_id))
+            texts.extend(cache.field_for('authors', book_id))
+
+    for text in texts:
+        if fold_accents(text) != strip_accents_nfd(text):
+            print('Mismatch: %r' % text)
+
+    def run_nfd():
+        for text in texts:
+            strip_accents_nfd(text)
+
+    def run_cold():
+        _fold_cache.clear()
+        for text in texts:
+            fold_accents(text)
+
+    def run_warm():
+        for text in texts:
+            fold_accents(text)
+
+    repeat = 5
+    print('%d strings, best of %d runs' % (len(texts), repeat))
+    def run_translate():
+        for text in texts:
+            text.translate(_fold_table)
+
+    run_warm()
+    for name, func in (('NFD + category', run_nfd), ('translate, no cache', run_translate),
+                       ('translate, cold cache', run_cold), ('translate, warm cache', run_warm)):
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        print('%-24s %8.2f ms' % (name, best * 1000))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
+__docformat__ = 'restructuredtext cs'
+
+import atexit
+import time
+import traceback
+from collections import namedtuple
+from Queue import Queue, Empty
+from threading import Condition, Thread, Timer
+
+from calibre import as_unicode
+
+from calibre_plugins.CBDB.worker import Worker
+
+# The part of the plugin options parsing a book page depends on
+ParseOptions = namedtuple('ParseOptions', 'get_all_authors')
+
+# Failed parses in a row after which the pool is no longer used
+MAX_FAILURES = 3
+# Seconds without a page parsed after which the processes are stopped, once
+# the identify that used them has finished
+IDLE_SHUTDOWN = 60
+# Seconds to wait for a process to load the plugins and to parse a page,
+# a process that takes longer is taken for hung and stopped
+START_TIMEOUT = 120
+PARSE_TIMEOUT = 30
+
+
+class ParserPoolError(Exception):
+    pass
+
+
+def call_with_timeout(w, timeout, *args):
+    '''
+    w(*args) for a worker process w, ParserPoolError when it has not
+    answered within timeout seconds. The caller then has to stop the
+    process, which also ends the thread still waiting for it.
+    '''
+    answers = Queue()
+
+    def call():
+        try:
+            answers.put((True, w(*args)))
+        except Exception as e:
+            answers.put((False, e))
+
+    t = Thread(target=call)
+    t.daemon = True
+    t.start()
+    try:
+        ok, value = answers.get(timeout=timeout)
+    except Empty:
+        raise ParserPoolError('No answer from the parser process in %d seconds' % timeout)
+    if not ok:
+        raise value
+    return value
+
+
+class RecordingLog(object):
+
+    '''
+    Log of a parser process, the messages are sent back with the record and
+    replayed into the worker's log. Only their text is kept, anything else
+    may not survive the trip between processes.
+    '''
+
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg):
+        self.messages.append(('info', as_unicode(msg)))
+
+    def error(self, msg):
+        self.messages.append(('error', as_unicode(msg)))
+
+    def exception(self, msg):
+        self.messages.append(('error', '%s\n%s' % (as_unicode(msg), as_unicode(traceback.format_exc()))))
+
+
+class PageParser(Worker):
+
+    '''
+    The parsing half of a Worker, without a browser or a thread
+    '''
+
+    def __init__(self, url, log, options, fields):
+        # Never started, so Thread.__init__ is not needed
+        self.url = url
+        self.log = log
+        self.options = options
+        self.fields = fields
+
+
+def parse_page(url, body, get_all_authors, fields, previous, fingerprint):
+    '''
+    Worker.parse_page() as run in a parser process. Returns the record, the
+    page fingerprint and the log messages.
+    '''
+    log = RecordingLog()
+    parser = PageParser(url, log, ParseOptions(get_all_authors), frozenset(fields))
+    try:
+        record, fp = parser.parse_page(body, previous, fingerprint)
+    except:
+        log.exception('Failed to parse CBDB details page: %r' % url)
+        record = fp = None
+    return record, fp, log.messages
+
+
+class ParserPool(object):
+
+    '''
+    calibre worker processes running parse_page(), shared by the Worker
+    threads of all identifies. Processes are started on demand, up to the
+    number set in the plugin options, and reused for the next pages.
+    '''
+
+    def __init__(self):
+        self.cond = Condition()
+        self.idle = []
+        self.started = 0
+        # Set when no process could be started or parsing failed MAX_FAILURES
+        # times in a row, pages are then parsed in the worker threads as before
+        self.broken = False
+        self.failures = 0
+        self.last_used = 0
+        self.timer = None
+        self.exit_registered = False
+
+    def start_process(self):
+        from calibre.utils.ipc.simple_worker import offload_worker
+        w = offload_worker()
+        # calibre_plugins.CBDB can only be imported once the plugins are loaded
+        try:
+            res = call_with_timeout(w, START_TIMEOUT, 'calibre.customize.ui', 'initialize_plugins')
+        except:
+            self.discard(w, started=False)
+            raise
+        if res['tb']:
+            self.discard(w, started=False)
+            raise ParserPoolError(res['tb'])
+        with self.cond:
+            if not self.exit_registered:
+                self.exit_registered = True
+                atexit.register(self.shutdown)
+        return w
+
+    def acquire(self, size):
+        with self.cond:
+            while not self.idle and self.started >= size:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.started += 1
+        try:
+            return self.start_process()
+        except:
+            self.broken = True
+            with self.cond:
+                self.started -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, w):
+        with self.cond:
+            self.idle.append(w)
+            self.last_used = time.time()
+            self.cond.notify()
+
+    def discard(self, w, started=True):
+        try:
+            w.shutdown()
+        except:
+            pass
+        if started:
+            with self.cond:
+                self.started -= 1
+                self.cond.notify()
+
+    def parse(self, size, *args):
+        w = self.acquire(size)
+        try:
+            res = call_with_timeout(w, PARSE_TIMEOUT, __name__, 'parse_page', *args)
+        except:
+            # The process died, hung or its connection broke, do not reuse it
+            self.discard(w)
+            self.record_failure()
+            raise
+        self.release(w)
+        if res['tb']:
+            self.record_failure()
+            raise ParserPoolError(res['tb'])
+        with self.cond:
+            self.failures = 0
+        return res['result']
+
+    def record_failure(self):
+        with self.cond:
+            self.failures += 1
+            if self.failures < MAX_FAILURES:
+                return
+            self.broken = True
+        self.shutdown()
+
+    def shutdown(self):
+        with self.cond:
+            idle, self.idle = self.idle, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        for w in idle:
+            self.discard(w)
+
+    def shutdown_later(self, delay=IDLE_SHUTDOWN):
+        '''
+        Stops the processes once no page has been parsed for delay seconds,
+        the next identify of a bulk download usually comes sooner
+        '''
+        with self.cond:
+            if not self.started or self.timer is not None:
+                return
+            self.timer = Timer(delay, self._shutdown_if_idle)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _shutdown_if_idle(self):
+        with self.cond:
+            self.timer = None
+            idle_for = time.time() - self.last_used
+            busy = len(self.idle) < self.started
+        if busy or idle_for < IDLE_SHUTDOWN:
+            self.shutdown_later(IDLE_SHUTDOWN if busy else IDLE_SHUTDOWN - idle_for)
+        else:
+            self.shutdown()
+
+
+parser_pool = ParserPool()
+
+
+def parse_in_pool(worker, body, previous=None, fingerprint=False):
+    '''
+    worker.parse_page() done by a parser process, so parsing a large batch
+    of pages uses more than one core. Returns None when no parser process is
+    available, the worker then parses the page itself.
+    '''
+    if parser_pool.broken:
+        return None
+    try:
+        record, fp, messages = parser_pool.parse(worker.options.parse_processes,
+                worker.url, body, worker.options.get_all_authors,
+                tuple(worker.fields), previous, fingerprint)
+    except:
+        worker.log.exception('Parser process failed, parsing in this thread: %r' % worker.url)
+        if parser_pool.broken:
+            worker.log.error('Parser processes failed %d times in a row, not using them any more' %
+                             MAX_FAILURES)
+        return None
+    for level, msg in messages:
+        getattr(worker.log, level)(msg)
+    return record, fp
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
+__docformat__ = 'restructuredtext cs'
+
+from Queue import Queue
+from threading import Event, Lock, Thread
+
+from calibre.utils.logging import default_log
+
+import calibre_plugins.CBDB as base
+from calibre_plugins.CBDB.bibliography import parse_bibliography, parse_html
+from calibre_plugins.CBDB.cache import page_cache, parsed_cache
+from calibre_plugins.CBDB.fetch import PRIORITY_PREFETCH, read_url, set_priority
+from calibre_plugins.CBDB.worker import Worker
+
+# Seconds between book page downloads, cached pages are not rate limited
+PREWARM_INTERVAL = 2
+
+# Sibling book pages downloaded per series, and in all per calibre session
+SERIES_PREFETCH_PER_SERIES = 10
+SERIES_PREFETCH_BUDGET = 200
+
+
+def fill_cache(plugin, browser, url, results, log):
+    '''
+    Downloads and parses a book page like identify does, which leaves it in
+    the page and parsed caches. Returns True when the book was found.
+    '''
+    try:
+        Worker(url, results, browser, log, 0, plugin).get_details()
+    except:
+        log.exception('Pre-warming failed for url: %r' % url)
+    # Only the cache is wanted here
+    found = False
+    while not results.empty():
+        results.get_nowait()
+        found = True
+    return found
+
+
+def library_CBDB_ids(db):
+    '''
+    CBDB ids of all books in the library that have one
+    '''
+    db = getattr(db, 'new_api', db)
+    ids = []
+    for identifiers in db.all_field_for('identifiers', db.all_book_ids()).itervalues():
+        CBDB_id = identifiers.get('cbdb')
+        if CBDB_id:
+            ids.append(CBDB_id)
+    return ids
+
+
+def prewarm(plugin, CBDB_ids, log=None, abort=None, notifications=None,
+            interval=PREWARM_INTERVAL):
+    '''
+    Downloads and parses the book page of every given CBDB id at prefetch
+    priority, filling the page and cover url caches ahead of the next
+    metadata download. Stops when abort is set. Returns the number of book
+    pages downloaded.
+    '''
+    log = log or default_log
+    abort = abort or Event()
+    set_priority(PRIORITY_PREFETCH)
+    browser = plugin.browser
+    results = Queue()
+    requested = fetched = 0
+    for i, CBDB_id in enumerate(CBDB_ids):
+        if abort.is_set():
+            break
+        url = base.BASE_BOOK_URL % (base.BASE_URL, CBDB_id)
+        from_network = not page_cache.has(url)
+        if from_network and requested:
+            abort.wait(interval)
+            if abort.is_set():
+                break
+        found = fill_cache(plugin, browser, url, results, log)
+        if from_network:
+            requested += 1
+            # Failed requests, also those refused while CBDB is considered
+            # down, leave nothing in the cache
+            fetched += found
+        if notifications is not None:
+            notifications.put(((i + 1) / len(CBDB_ids), 'Pre-warmed %d of %d CBDB books' % (i + 1, len(CBDB_ids))))
+        if (i + 1) % 50 == 0:
+            log.info('Pre-warmed %d of %d CBDB books' % (i + 1, len(CBDB_ids)))
+    if abort.is_set():
+        log.info('Pre-warming cancelled, %d book pages downloaded' % fetched)
+    else:
+        log.info('Pre-warming done, %d book pages downloaded' % fetched)
+    return fetched
+
+
+def start_prewarm(plugin, db, gui):
+    '''
+    Runs prewarm() for the books of the library as a calibre job, stopping
+    the job in the Jobs list cancels it. Returns the number of books.
+    '''
+    from calibre.gui2.threaded_jobs import ThreadedJob
+    CBDB_ids = library_CBDB_ids(db)
+    job = ThreadedJob('cbdb_prewarm', 'Pre-warm the CBDB cache for %d books' % len(CBDB_ids),
+                      prewarm, (plugin, CBDB_ids), {}, lambda job: None)
+    gui.job_manager.run_threaded_job(job)
+    return len(CBDB_ids)
+
+
+class SeriesPrefetcher(object):
+
+    '''
+    Downloads the other volumes of the series of books being identified, at
+    prefetch priority in a single background thread, so a bulk download
+    finds them cached when it gets to them. Each series is done once per
+    calibre session and the number of pages downloaded is limited.
+    '''
+
+    def __init__(self, budget=SERIES_PREFETCH_BUDGET, per_series=SERIES_PREFETCH_PER_SERIES,
+                 interval=PREWARM_INTERVAL, log=None):
+        self.budget = budget
+        self.per_series = per_series
+        self.interval = interval
+        self.log = log or default_log
+        self.lock = Lock()
+        self.seen = set()
+        self.jobs = Queue()
+        self.thread = None
+        self.abort = Event()
+
+    def add(self, plugin, series_url, book_url):
+        with self.lock:
+            if self.budget <= 0 or series_url in self.seen:
+                return
+            self.seen.add(series_url)
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name='CBDBSeriesPrefetch')
+                self.thread.daemon = True
+                self.thread.start()
+        self.jobs.put((plugin, series_url, book_url))
+
+    def take_budget(self):
+        with self.lock:
+            if self.budget <= 0:
+                return False
+            self.budget -= 1
+            return True
+
+    def run(self):
+        set_priority(PRIORITY_PREFETCH)
+        results = Queue()
+        while not self.abort.is_set():
+            plugin, series_url, book_url = self.jobs.get()
+            browser = plugin.browser
+            try:
+                books = parse_bibliography(parse_html(read_url(browser, series_url, 20, self.log)))
+            except:
+                self.log.exception('Failed to read series page: %r' % series_url)
+                continue
+            book_id = base.parse_CBDB_id(book_url)
+            urls = [url for title, url in books if base.parse_CBDB_id(url) != book_id]
+            fetched = 0
+            for url in urls[:self.per_series]:
+                if page_cache.has(url) or parsed_cache.get(base.parse_CBDB_id(url)) is not None:
+                    continue
+                if self.abort.wait(self.interval) or not self.take_budget():
+                    break
+                fetched += fill_cache(plugin, browser, url, results, self.log)
+            self.log.info('Prefetched %d books of the series %r' % (fetched, series_url))
+
+
+series_prefetcher = SeriesPrefetcher()
@@ -7,18 +7,45 @@ __license__   = 'GPL v3'
 __copyright__ = '2013, Ignac Cerda <cerda@centrum.cz>'
 __docformat__ = 'restructuredtext cs'
 
-import socket, re, datetime
-from collections import OrderedDict
+import socket, re, datetime, hashlib
+from collections import OrderedDict, namedtuple
 from threading import Thread
 
 from lxml.html import fromstring, tostring
 
+from calibre import as_unicode
+from calibre.ebooks.metadata import check_isbn
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.library.comments import sanitize_comments_html
 from calibre.utils.cleantext import clean_ascii_chars
 
 import calibre_plugins.CBDB.config as cfg
 import calibre_plugins.CBDB as base
+from calibre_plugins.CBDB.cache import fingerprints, page_cache, parsed_cache
+from calibre_plugins.CBDB.fetch import (CircuitOpenError, current_priority, is_interactive,
+        read_url, PRIORITY_PREFETCH)
+
+# Fields filled in from the releases table
+EDITION_FIELDS = frozenset(['publisher', 'pubdate', 'identifier:isbn'])
+
+# Parts of a book page the metadata comes from, a change anywhere else on
+# the page does not count for an incremental refresh
+FINGERPRINT_XPATHS = (
+    '//div[@class="content"]/div/h1/span',
+    '//table[@id="book_info"]',
+    '//td[@id="book_covers"]//img/@src',
+    '//div[@itemprop="aggregateRating"]',
+    '//div[@id="annotation"]',
+    '//div[@id="releases"]',
+    '//div[@class="stacked"]/div/div/div[contains(@class, "bigBoxContent")]',
+)
+
+# One row of the releases table on a book page
+Edition = namedtuple('Edition', 'publisher year isbn pages note')
+
+# Words in release notes marking an audiobook edition, "audio" also as the
+# start of a word as in "audiokniha"
+AUDIO_EDITION_RE = re.compile(r'\b(?:audio\w*|cd|mp3)\b', re.IGNORECASE | re.UNICODE)
 
 class Worker(Thread): # Get details
 
@@ -26,7 +53,7 @@ class Worker(Thread): # Get details
     Get book details from CBDB book page in a separate thread
     '''
 
-    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20):
+    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20, options=None, raw=None, fields=None, isbn=None, CBDB_id=None, decisive=None, exact=None, priority=None):
         Thread.__init__(self)
         self.daemon = True
         self.url = url
@@ -36,6 +63,19 @@ class Worker(Thread): # Get details
         self.relevance = relevance
         self.plugin = plugin
         self.browser = browser.clone_browser()
+        self.options = options if options is not None else cfg.get_options_snapshot()
+        # Page body already downloaded by identify, e.g. an ISBN search redirect
+        self.raw = raw
+        # Only the extractors for these fields are run
+        self.fields = fields if fields is not None else plugin.touched_fields
+        # ISBN the book was searched by, its edition is preferred
+        self.query_isbn = isbn
+        self.query_CBDB_id = CBDB_id
+        # Shared with the other workers of the same identify, see is_decisive()
+        self.decisive = decisive
+        self.exact = exact
+        # Requests are made with the priority of the thread that created us
+        self.priority = priority if priority is not None else current_priority()
         self.cover_urls = self.CBDB_id = self.isbn = None
 
     def run(self):
@@ -44,15 +84,78 @@ class Worker(Thread): # Get details
         except:
             self.log.exception('get_details failed for url: %r'%self.url)
 
+    def is_cancelled(self):
+        return self.decisive is not None and self.decisive.is_set()
+
+    def is_decisive(self, mi):
+        # exact is the TokenMatcher of a title/author search, set when there
+        # are several candidates to choose from
+        return self.exact is not None and self.exact.is_exact(mi.title, mi.authors)
+
+    def page_fingerprint(self, root):
+        h = hashlib.sha1()
+        for xpath in FINGERPRINT_XPATHS:
+            for node in root.xpath(xpath):
+                text = node if isinstance(node, basestring) else node.text_content()
+                h.update(text.encode('utf-8') + b'\x1f')
+        return h.hexdigest()
+
+    def options_digest(self):
+        '''
+        Digest of everything besides the page the returned metadata depends
+        on, stored with the page fingerprint so a refresh after an options
+        or genre mapping change returns the book again
+        '''
+        o = self.options
+        h = hashlib.sha1()
+        h.update(repr((o.get_editions, o.get_all_authors, sorted(o.genre_tag_index.iteritems()),
+                       sorted(self.fields), self.query_isbn)).encode('utf-8'))
+        return h.hexdigest()
+
+    def put_cached_record(self):
+        try:
+            record = parsed_cache.get(self.parse_CBDB_id(self.url))
+        except:
+            self.log.exception('Failed to read cached metadata for url: %r'%self.url)
+            return False
+        if record is None or not self.record_is_usable(record):
+            return False
+        self.log.info('Using cached metadata')
+        self.put_record(record)
+        return True
+
     def get_details(self):
+        if self.is_cancelled():
+            return
+        # A download the user is waiting on always returns the book, and with
+        # refresh_interactive gets the current page, which then replaces the
+        # cached one
+        interactive = is_interactive(self.priority)
+        # Refreshing a known book: only return it if its page has changed
+        incremental = bool(self.options.incremental_refresh and self.query_CBDB_id and
+                           not interactive)
+        refresh = self.options.refresh_interactive and interactive
+        cached = False
         try:
             self.log.info('CBDB book url: %r'%self.url)
             ### offline test
-            raw = self.browser.open_novisit(self.url, timeout=self.timeout).read().strip()
-            raw = raw.decode('utf-8', errors='replace')
+            if self.raw is None and not incremental and not refresh and self.put_cached_record():
+                return
+            body = self.raw
+            if body is None and not incremental and not refresh:
+                body = page_cache.get(self.url)
+                if body is not None:
+                    self.log.info('Using cached book page')
+                    cached = True
+            if body is None:
+                body = read_url(self.browser, self.url, self.timeout, self.log,
+                                hedge=self.options.hedge_requests, priority=self.priority)
             #open('S:\\d.html', 'wb').write(raw)
             ###raw = open('S:\\d.html', 'rb').read()
                         
+        except CircuitOpenError as e:
+            self.log.error('%s, skipping: %r'%(as_unicode(e), self.url))
+            return
         except Exception as e:
             if callable(getattr(e, 'getcode', None)) and \
                     e.getcode() == 404:
@@ -68,6 +171,58 @@ class Worker(Thread): # Get details
                 self.log.exception(msg)
             return
 
+        if self.is_cancelled():
+            return
+
+        previous = None
+        if incremental:
+            # Stored as <page fingerprint>:<options digest>
+            digest = self.options_digest()
+            stored = fingerprints.get(self.query_CBDB_id) or ''
+            if stored.endswith(':' + digest):
+                previous = stored[:-len(digest) - 1]
+        parsed = None
+        if self.options.parse_processes:
+            from calibre_plugins.CBDB.parsing import parse_in_pool
+            parsed = parse_in_pool(self, body, previous, incremental)
+        if parsed is None:
+            parsed = self.parse_page(body, previous, incremental)
+        record, fingerprint = parsed
+
+        if fingerprint is not None and not cached:
+            # Only pages that parsed as a book page are cached
+            try:
+                page_cache.put(self.url, body)
+            except:
+                self.log.exception('Failed to cache book page: %r'%self.url)
+
+        if record is None or self.is_cancelled():
+            return
+
+        try:
+            parsed_cache.put(record['cbdb_id'], record)
+        except:
+            self.log.exception('Failed to cache parsed metadata for url: %r'%self.url)
+        if self.options.local_index:
+            from calibre_plugins.CBDB.index import book_index
+            try:
+                if book_index.ready():
+                    book_index.add(record, self.url)
+            except:
+                self.log.exception('Failed to add book to the local index: %r'%self.url)
+        self.put_record(record)
+
+        if incremental and self.CBDB_id:
+            try:
+                fingerprints.put(self.query_CBDB_id, '%s:%s' % (fingerprint, digest))
+            except:
+                self.log.exception('Failed to store page fingerprint: %r'%self.url)
+
+    def parse_root(self, body):
+        '''
+        The book page as an lxml tree, or None when body is not a book page
+        '''
+        raw = body.strip().decode('utf-8', errors='replace')
         if '<title>404 - ' in raw:
             self.log.error('URL malformed: %r'%self.url)
             return
@@ -77,7 +232,7 @@ class Worker(Thread): # Get details
             idxs = cln.find('<!DOCTYPE')
             
             if (idxs == -1):
-                log.error('Failed to find HTML document')
+                self.log.error('Failed to find HTML document')
                 return
                         
             root = fromstring(cln[idxs:])
@@ -108,10 +263,40 @@ class Worker(Thread): # Get details
             msg += tostring(errmsg, method='text', encoding=unicode).strip()
             self.log.error(msg)
             return
-
-        self.parse_details(root)
-
-    def parse_details(self, root):
+        return root
+
+    def parse_page(self, body, previous=None, fingerprint=False):
+        '''
+        (record, fingerprint) for the raw page body. All of the CPU heavy work
+        happens here, so it may also run in a parser process, see parsing.py.
+        The record is None when the page is not usable or, with fingerprint
+        set, when the page has not changed since previous.
+        '''
+        root = self.parse_root(body)
+        if root is None:
+            return None, None
+        # Also tells the caller the page was a book page
+        fp = self.page_fingerprint(root) if fingerprint else ''
+        if fingerprint and fp == previous:
+            self.log.info('CBDB book page has not changed, skipping: %r'%self.url)
+            return None, fp
+        return self.parse_record(root), fp
+
+    def parsed_groups(self):
+        # Optional parts of the page wanted for self.fields
+        groups = set()
+        for group in ('rating', 'comments', 'tags'):
+            if group in self.fields:
+                groups.add(group)
+        if not self.fields.isdisjoint(EDITION_FIELDS):
+            groups.add('editions')
+        return groups
+
+    def parse_record(self, root):
+        '''
+        Everything needed for the result, as a plain dict that can be cached
+        and turned into Metadata by put_record()
+        '''
         try:
             CBDB_id = self.parse_CBDB_id(self.url)
         except:
@@ -135,48 +320,96 @@ class Worker(Thread): # Get details
             self.log.error('CBDB: %r Title: %r Authors: %r'%(CBDB_id, title, authors))
             return
 
-        mi = Metadata(title, authors)
+        groups = self.parsed_groups()
+        record = {'cbdb_id': CBDB_id, 'title': title, 'series': series,
+                  'series_index': series_index, 'authors': authors,
+                  'all_authors': self.options.get_all_authors,
+                  'groups': sorted(groups)}
+
+        # The series page lists the other volumes, see prewarm.SeriesPrefetcher
         if series:
-            mi.series = series
-            mi.series_index = series_index
-        #mi.identifiers['cbdb'] = CBDB_id
-        mi.set_identifier('cbdb', CBDB_id)
-        #self.log.info(CBDB_id)
-        #self.log.info(mi.identifiers.get('cbdb', None))
-        self.CBDB_id = CBDB_id        
+            try:
+                record['series_url'] = self.parse_series_url(root)
+            except:
+                self.log.exception('Error parsing series url for url: %r'%self.url)
 
-        try:
-            mi.rating = self.parse_rating(root)
-        except:
-            self.log.exception('Error parsing ratings for url: %r'%self.url)
+        if 'rating' in groups:
+            try:
+                record['rating'] = self.parse_rating(root)
+            except:
+                self.log.exception('Error parsing ratings for url: %r'%self.url)
 
         # summary
-        try:
-            mi.comments = self.parse_comments(root)
-        except:
-            self.log.exception('Error parsing comments for url: %r'%self.url)
+        if 'comments' in groups:
+            try:
+                record['comments'] = self.parse_comments(root)
+            except:
+                self.log.exception('Error parsing comments for url: %r'%self.url)
 
+        # Covers are always wanted, download_cover relies on the cached urls
         try:
-            self.cover_urls = self.parse_covers(root)
+            record['cover_urls'] = self.parse_covers(root)
         except:
             self.log.exception('Error parsing cover for url: %r'%self.url)
-        mi.has_cover = bool(self.cover_urls)
         #self.log.info('covers')
-        #self.log.info(self.cover_urls)
+        #self.log.info(record.get('cover_urls'))
 
-        try:
-            tags = self.parse_tags(root)
+        # Genres are mapped to tags when the result is built, so cached
+        # records follow changes to the mappings
+        if 'tags' in groups:
+            try:
+                record['genres'] = self.parse_genres(root)
+            except:
+                self.log.exception('Error parsing tags for url: %r'%self.url)
+
+        # Likewise the edition is chosen when the result is built, it
+        # depends on the ISBN searched for
+        if 'editions' in groups:
+            try:
+                record['editions'] = [list(e) for e in self.parse_edition_records(root)]
+            except:
+                self.log.exception('Error parsing publisher and date for url: %r'%self.url)
+
+        return record
+
+    def record_is_usable(self, record):
+        return (record.get('all_authors') == self.options.get_all_authors and
+                self.parsed_groups().issubset(record.get('groups', ())))
+
+    def put_record(self, record):
+        CBDB_id = record['cbdb_id']
+        mi = Metadata(record['title'], record['authors'])
+        if record['series']:
+            mi.series = record['series']
+            mi.series_index = record['series_index']
+        #mi.identifiers['cbdb'] = CBDB_id
+        mi.set_identifier('cbdb', CBDB_id)
+        #self.log.info(CBDB_id)
+        #self.log.info(mi.identifiers.get('cbdb', None))
+        self.CBDB_id = CBDB_id
+
+        if 'rating' in self.fields and record.get('rating') is not None:
+            mi.rating = record['rating']
+
+        if 'comments' in self.fields and record.get('comments') is not None:
+            mi.comments = record['comments']
+
+        self.cover_urls = record.get('cover_urls')
+        mi.has_cover = bool(self.cover_urls)
+
+        if 'tags' in self.fields and record.get('genres'):
+            tags = self._convert_genres_to_calibre_tags(record['genres'])
             if tags:
                 mi.tags = tags
-        except:
-            self.log.exception('Error parsing tags for url: %r'%self.url)
 
-        try:
-            mi.publisher, mi.pubdate, isbn = self.parse_editions(root)
-            if isbn:
-                 self.isbn = mi.isbn = isbn
-        except:
-            self.log.exception('Error parsing publisher and date for url: %r'%self.url)
+        if not self.fields.isdisjoint(EDITION_FIELDS) and 'editions' in record:
+            try:
+                editions = [Edition(*e) for e in record['editions']]
+                mi.publisher, mi.pubdate, isbn = self.publication_from_editions(editions)
+                if isbn:
+                     self.isbn = mi.isbn = isbn
+            except:
+                self.log.exception('Error parsing publisher and date for url: %r'%self.url)
 
         mi.source_relevance = self.relevance
         
@@ -195,10 +428,19 @@ class Worker(Thread): # Get details
 
         self.result_queue.put(mi)
 
+        if self.decisive is not None and self.is_decisive(mi):
+            self.decisive.set()
+
+        # Books fetched speculatively do not start more prefetching
+        if (record.get('series_url') and self.options.series_prefetch and
+                self.priority != PRIORITY_PREFETCH):
+            from calibre_plugins.CBDB.prewarm import series_prefetcher
+            series_prefetcher.add(self.plugin, record['series_url'], self.url)
+
     def parse_CBDB_id(self, url):
         #self.log.info(url)
         #self.log.info(url.split('/')[-1])
-        return url.split('/')[-1].split('-')[1]
+        return base.parse_CBDB_id(url)
 
     def parse_title_series(self, root):
         title_node = root.xpath('//div[@class="content"]/div/h1/span')
@@ -254,12 +496,16 @@ class Worker(Thread): # Get details
                 title = title_text
         return (title.strip(), None, None)
 
+    def parse_series_url(self, root):
+        series_node = root.xpath('//div[@class="content"]//a[contains(@href, "serie-")]/@href')
+        if series_node:
+            href = series_node[0].strip()
+            return href if href.startswith('http') else base.BASE_URL + '/' + href.lstrip('/')
+
     def parse_authors(self, root):
         authors = []
-        get_all_authors = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GET_ALL_AUTHORS]
-        if get_all_authors:
+        if self.options.get_all_authors:
             author_node = root.xpath('//table[@id="book_info"]/tr/td[@class="v_top"]/a')
-            self.log.info(author_node)
             if author_node:
                 authors = []
                 for author_value in author_node:
@@ -323,138 +569,120 @@ class Worker(Thread): # Get details
                 #for        
         return img_urls
 
-    def parse_editions(self, root):
-        publisher = None
-        pub_date = None
-        pub_isbn = None
-        publisher_node = root.xpath('//div[@id="releases"]/table/tr')
-        if publisher_node:
-            # <div id="releases">
-            #  <table>
-            #   <tr>
-            #   <td><strong>Nakladatelstv�&nbsp;(rok)</strong></td>
-            #   <td><strong>ISBN</strong></td>
-            #   <td><strong>Pocet&nbsp;stran</strong></td>
-            #   <td><strong>Pozn�mka</strong></td>
-            #   </tr>
-            #   <tr>
-            #     <td>
-            #       Rozmluvy
-            #       (2009)
-            #     </td>
-            #     <td>
-            #       978-80-85336-67-2
-            #     </td>
-            #     <td>
-            #       120
-            #     </td>
-            #     <td class="releases_note">
-            #     </td>
-            #   </tr>
-            #   <tr>
-            #     <td>
-            #       Ceskoslovensk� spisovatel
-            #       (1970)
-            #     </td>
-            #     <td>
-            #     </td>
-            #     <td>
-            #     </td>
-            #     <td class="releases_note">
-            #     </td>
-            #   </tr>
-            #   <tr>
-            #     <td>
-            #       �torch-Marien
-            #       (1924)
-            #     </td>
-            #     <td>
-            #     </td>
-            #     <td>
-            #     </td>
-            #     <td class="releases_note">
-            #     </td>
-            #   </tr>
-            #   </table>
-            #   <span class="show_covers" onClick="hide_releases();">Skr�t vyd�n�</span><br /><br />
-            # </div>
-            #self.log.info(publisher_node.__len__())
-            
-            cnt = publisher_node.__len__()
-            i = 1
-            while i < cnt:
-                pub_edition = publisher_node[i].xpath('./td')
-                
-                if pub_edition:
-                    publisher_text = pub_edition[0].text_content().strip()
-                    
-                    # publisher & publication date
-                    pub = publisher_text.split('(')
-                    if pub[1]:
-                        psher = pub[0].strip()
-                        pdate = pub[1].strip()
-                        pdate = pdate[:-1]
-                        #self.log.info(psher)
-                        #self.log.info(pdate)
-                        
-                        if (publisher == None):
-                            publisher = ''
-                        else:
-                            publisher += ', '
-                                
-                        publisher += psher + ' | ' + pdate
-                    
-                    # isbn
-                    pub = pub_edition[1].text_content().strip()
-                    if pub:
-                        #self.log.info(pub)
-                        if (pub_isbn == None):
-                            pub_isbn = pub
-                        
-                        publisher += ' | ' + pub                          
-                                            
-                i += 1
-            #wend
-            
-            if (cnt == 2):
-                pub = publisher.split('|')
-                publisher = pub[0].strip()
-                pubdate_text = pub[1].strip()
-                
-                if pubdate_text:
-                    pub_date = self._convert_date_text(pubdate_text)
-            
-            #self.log.info(publisher)
-            #self.log.info(pub_date)
-            #self.log.info(pub_isbn)
-        return (publisher, pub_date, pub_isbn)
+    def parse_edition_records(self, root):
+        # <div id="releases">
+        #  <table>
+        #   <tr>
+        #   <td><strong>Nakladatelstv�&nbsp;(rok)</strong></td>
+        #   <td><strong>ISBN</strong></td>
+        #   <td><strong>Pocet&nbsp;stran</strong></td>
+        #   <td><strong>Pozn�mka</strong></td>
+        #   </tr>
+        #   <tr>
+        #     <td>
+        #       Rozmluvy
+        #       (2009)
+        #     </td>
+        #     <td>
+        #       978-80-85336-67-2
+        #     </td>
+        #     <td>
+        #       120
+        #     </td>
+        #     <td class="releases_note">
+        #     </td>
+        #   </tr>
+        #   <tr>
+        #     <td>
+        #       Ceskoslovensk� spisovatel
+        #       (1970)
+        #     </td>
+        #     <td>
+        #     </td>
+        #     <td>
+        #     </td>
+        #     <td class="releases_note">
+        #     </td>
+        #   </tr>
+        #   <tr>
+        #     <td>
+        #       �torch-Marien
+        #       (1924)
+        #     </td>
+        #     <td>
+        #     </td>
+        #     <td>
+        #     </td>
+        #     <td class="releases_note">
+        #     </td>
+        #   </tr>
+        #   </table>
+        #   <span class="show_covers" onClick="hide_releases();">Skr�t vyd�n�</span><br /><br />
+        # </div>
+        editions = []
+        # The first row holds the column headings
+        for row in root.xpath('//div[@id="releases"]/table/tr')[1:]:
+            cells = [td.text_content().strip() for td in row.xpath('./td')]
+            if not cells:
+                continue
+            cells += [''] * (4 - len(cells))
+            publisher, sep, year = cells[0].rpartition('(')
+            if sep:
+                publisher = publisher.strip()
+                year = year.rstrip(')').strip()
+            else:
+                publisher, year = cells[0], ''
+            editions.append(Edition(publisher, year, cells[1], cells[2], cells[3]))
+        return editions
+
+    def select_edition(self, editions):
+        # The edition matching the ISBN searched for wins, otherwise the only
+        # edition left once audiobooks are skipped (if configured to)
+        if self.query_isbn:
+            for edition in editions:
+                if edition.isbn and check_isbn(edition.isbn) == self.query_isbn:
+                    return edition
+        if self.options.get_editions:
+            editions = [e for e in editions
+                        if not AUDIO_EDITION_RE.search(e.note)] or editions
+        if len(editions) == 1:
+            return editions[0]
+
+    def publication_from_editions(self, editions):
+        if not editions:
+            return (None, None, None)
+
+        edition = self.select_edition(editions)
+        if edition is not None:
+            pub_date = self._convert_date_text(edition.year) if edition.year else None
+            return (edition.publisher or None, pub_date, edition.isbn or None)
 
-    def parse_tags(self, root):
+        # No single edition to go by, so list all of them as the publisher
+        # and use the first ISBN found
+        publisher = ', '.join(' | '.join(f for f in (e.publisher, e.year, e.isbn) if f)
+                              for e in editions)
+        pub_isbn = next((e.isbn for e in editions if e.isbn), None)
+        return (publisher or None, None, pub_isbn)
+
+    def parse_genres(self, root):
         # CBDB does not have "tags", but it does have Genres (wrapper around popular shelves)
         # We will use those as tags (with a bit of massaging)
+        genre_tags = list()
         genres_node = root.xpath('//div[@class="stacked"]/div/div/div[contains(@class, "bigBoxContent")]/div/div')
-        if genres_node:
-            genre_tags = list()
-            for genre_node in genres_node:
-                sub_genre_nodes = genre_node.xpath('a')
-                genre_tags_list = [sgn.text_content().strip() for sgn in sub_genre_nodes]
-                if genre_tags_list:
-                    genre_tags.append(' > '.join(genre_tags_list))
-            calibre_tags = self._convert_genres_to_calibre_tags(genre_tags)
-            if len(calibre_tags) > 0:
-                return calibre_tags
+        for genre_node in genres_node:
+            sub_genre_nodes = genre_node.xpath('a')
+            genre_tags_list = [sgn.text_content().strip() for sgn in sub_genre_nodes]
+            if genre_tags_list:
+                genre_tags.append(' > '.join(genre_tags_list))
+        return genre_tags
 
     def _convert_genres_to_calibre_tags(self, genre_tags):
         # for each tag, add if we have a dictionary lookup
-        calibre_tag_lookup = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GENRE_MAPPINGS]
-        calibre_tag_map = dict((k.lower(),v) for (k,v) in calibre_tag_lookup.iteritems())
-        tags_to_add = list()
+        calibre_tag_map = self.options.genre_tag_index
+        tags_to_add = OrderedDict()
         for genre_tag in genre_tags:
-            tags = calibre_tag_map.get(genre_tag.lower(), None)
-            if tags:
-                for tag in tags:
-                    if tag not in tags_to_add:
-                        tags_to_add.append(tag)
+            for tag in calibre_tag_map.get(genre_tag.lower(), ()):
+                tags_to_add[tag] = True
         return list(tags_to_add)
 
     def _convert_date_text(self, date_text):